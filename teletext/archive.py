@@ -0,0 +1,215 @@
+import bz2
+import io
+import lzma
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+from .compression import CompressedFile
+
+
+# File layout:
+#
+#   HEADER
+#   BLOCK, payload       (repeated)
+#   BLOCK(0, 0)          end of blocks
+#   index                (blocks+1, 2) int64 of (file offset, uncompressed offset)
+#   sequence             (frames,) uint32 of the last 4 bytes of each frame
+#   TRAILER
+#
+# Each payload holds whole frames of lines. The samples of each line are
+# replaced by the difference from the previous sample, split into byte
+# planes if they are wider than a byte, and then compressed. A partial
+# line at the end of the input is stored as is after the lines.
+
+MAGIC = b'VBIPACK1'
+INDEX_MAGIC = b'VBIINDEX'
+
+HEADER = struct.Struct('<8sIBBH')   # magic, line size, sample size, codec, lines per frame
+BLOCK = struct.Struct('<II')        # payload size, uncompressed size
+TRAILER = struct.Struct('<QQQ8s')   # index offset, blocks, frames, magic
+
+codecs = {
+    'zlib': (0, zlib.compress, zlib.decompress),
+    'bz2': (1, bz2.compress, bz2.decompress),
+    'xz': (2, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+
+def is_archive(f):
+    """Whether buffered binary file f is a VBI archive."""
+    try:
+        return f.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return False
+
+
+def encode(data, line_size, sample_size):
+    """Delta encode the lines of a bytes object."""
+    lines = len(data) // line_size
+    if lines == 0:
+        return data
+    dtype = np.dtype(f'<u{sample_size}')
+    a = np.frombuffer(data, dtype=dtype, count=lines * line_size // sample_size).reshape(lines, -1)
+    d = np.diff(a, axis=1, prepend=dtype.type(0))
+    if sample_size > 1:
+        d = d.view(np.uint8).reshape(lines, -1, sample_size).transpose(2, 0, 1)
+    return d.tobytes() + data[lines * line_size:]
+
+
+def decode(data, size, line_size, sample_size):
+    """Undo encode() for size bytes of lines."""
+    lines = size // line_size
+    if lines == 0:
+        return data
+    dtype = np.dtype(f'<u{sample_size}')
+    d = np.frombuffer(data, dtype=np.uint8, count=lines * line_size)
+    if sample_size > 1:
+        d = d.reshape(sample_size, lines, -1).transpose(1, 2, 0).copy().view(dtype)
+    else:
+        d = d.reshape(lines, -1)
+    a = np.cumsum(d, axis=1, dtype=dtype)
+    return a.tobytes() + data[lines * line_size:]
+
+
+class ArchiveWriter(object):
+
+    """
+    Writes raw VBI samples to a VBI archive.
+
+    Only writes and never seeks, so the output can be a pipe. Data must be
+    written in whole frames, except at the end.
+    """
+
+    def __init__(self, f, line_size, sample_size=1, frame_lines=32, codec='zlib', level=6):
+        self._f = f
+        self.line_size = line_size
+        self.sample_size = sample_size
+        self.frame_lines = frame_lines
+        self._codec, self._compress, _ = codecs[codec]
+        self._level = level
+        self._index = []
+        self._sequence = []
+        self._offset = HEADER.size
+        self.size = 0
+        self.compressed = 0
+        f.write(HEADER.pack(MAGIC, line_size, sample_size, self._codec, frame_lines))
+
+    def write(self, data):
+        """Write a block of frames."""
+        frame_size = self.frame_lines * self.line_size
+        if frame_size >= 4:
+            self._sequence.extend(
+                struct.unpack('<I', data[n-4:n])[0] for n in range(frame_size, len(data) + 1, frame_size)
+            )
+        payload = self._compress(encode(data, self.line_size, self.sample_size), self._level)
+        self._index.append((self._offset, self.size))
+        self._f.write(BLOCK.pack(len(payload), len(data)))
+        self._f.write(payload)
+        self._offset += BLOCK.size + len(payload)
+        self.size += len(data)
+        self.compressed += len(payload)
+
+    @property
+    def sequence(self):
+        """The sequence numbers of the frames written so far."""
+        return np.array(self._sequence, dtype=np.uint32)
+
+    def close(self):
+        """Write the end marker and the index. Does not close the file."""
+        self._index.append((self._offset, self.size))
+        self._f.write(BLOCK.pack(0, 0))
+        index_offset = self._offset + BLOCK.size
+        self._f.write(np.array(self._index, dtype='<i8').tobytes())
+        self._f.write(self.sequence.astype('<u4').tobytes())
+        self._f.write(TRAILER.pack(index_offset, len(self._index) - 1, len(self._sequence), INDEX_MAGIC))
+
+
+class ArchiveFile(CompressedFile):
+
+    """
+    Read-only file object which unpacks a VBI archive.
+
+    If the archive can be seeked, its index is read and it can be seeked
+    to any position like a CompressedFile with a block index. Otherwise it
+    is unpacked from start to end.
+    """
+
+    def __init__(self, fileobj, name=None):
+        self._fileobj = fileobj
+        self.fmt = 'archive'
+        self.name = name
+        magic, self.line_size, self.sample_size, codec, self.frame_lines = HEADER.unpack(fileobj.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('Not a VBI archive.')
+        self._decompress = next(d for c, _, d in codecs.values() if c == codec)
+        self._index = None
+        self.sequence = None
+        try:
+            self._read_index()
+        except io.UnsupportedOperation:
+            pass
+        except OSError:
+            # No index, such as when pack was interrupted. Unpack the
+            # blocks which are there from the start.
+            self._fileobj.seek(HEADER.size)
+        self._pos = 0
+        self._reset()
+
+    def _read_index(self):
+        self._fileobj.seek(-TRAILER.size, os.SEEK_END)
+        index_offset, blocks, frames, magic = TRAILER.unpack(self._fileobj.read(TRAILER.size))
+        if magic != INDEX_MAGIC:
+            raise OSError('VBI archive has no index.')
+        self._fileobj.seek(index_offset)
+        self._index = np.frombuffer(self._fileobj.read((blocks + 1) * 16), dtype='<i8').reshape(-1, 2).astype(np.int64)
+        self.sequence = np.frombuffer(self._fileobj.read(frames * 4), dtype='<u4')
+        self._fileobj.seek(HEADER.size)
+
+    def _restart(self, member):
+        if self._index is None:
+            self._fileobj.seek(HEADER.size)
+            self._pos = 0
+        else:
+            self._fileobj.seek(int(self._index[member, 0]))
+            self._pos = int(self._index[member, 1])
+        self._reset()
+
+    def _fill(self):
+        head = self._fileobj.read(BLOCK.size)
+        if len(head) < BLOCK.size:
+            return False
+        length, size = BLOCK.unpack(head)
+        if size == 0:
+            return False
+        payload = self._fileobj.read(length)
+        if len(payload) < length:
+            # A block cut short at the end of a truncated archive.
+            return False
+        data = self._decompress(payload)
+        self._buffer = decode(data, size, self.line_size, self.sample_size)
+        self._offset = 0
+        return True
+
+
+def pack(input, output, line_size, sample_size=1, frame_lines=32, block_frames=25, codec='zlib', level=6):
+    """Pack raw VBI samples from input into an archive written to output.
+
+    Returns the ArchiveWriter, for its statistics.
+    """
+    writer = ArchiveWriter(output, line_size, sample_size, frame_lines, codec, level)
+    while True:
+        data = input.read(frame_lines * line_size * block_frames)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+    return writer
+
+
+def unpack(input, output):
+    """Write the raw VBI samples from an archive to output."""
+    shutil.copyfileobj(ArchiveFile(input), output, 1<<20)
@@ -1,3 +1,4 @@
+import contextlib
 import itertools
 import multiprocessing
 import os
@@ -10,9 +11,9 @@ import click
 from tqdm import tqdm
 
 from .clihelpers import packetreader, packetwriter, paginated, progressparams, filterparams, carduser, chunkreader, \
-    command, profileopts
+    command, profileopts, blockprogress
 from .file import FileChunker
-from .mp import itermap
+from .mp import itermap, ChunkSizer, PureGeneratorPool
 from .packet import Packet, np
 from .stats import StatsList, MagHistogram, RowHistogram, Rejects, ErrorHistogram
 from .subpage import Subpage
@@ -54,7 +55,7 @@ def filter(packets, pages, subpages, paginate):
 @command(teletext, name='list')
 @click.option('-s', '--subpages', is_flag=True, help='Also list subpages.')
 @paginated(always=True, filtered=False)
-@packetreader
+@packetreader(headers=True)
 @progressparams(progress=True, mag_hist=True)
 def _list(packets, subpages):
 
@@ -222,6 +223,17 @@ def html(packets, outdir, template):
     svc.to_html(outdir, template)
 
 
+@command(teletext, name='index')
+@click.argument('input', type=click.File('rb'), required=True)
+def _index(input):
+    """Build a page index so pages can be read from a t42 file without scanning it."""
+    from teletext import pageindex
+
+    index = pageindex.build(input)
+    pageindex.save(input.name, index)
+    sys.stderr.write(f'{len(index["number"])} headers.\n')
+
+
 @command(teletext)
 @click.argument('output', type=click.File('wb'), default='-')
 @click.option('-d', '--device', type=click.File('rb'), default='/dev/vbi0', help='Capture device.')
@@ -272,7 +284,7 @@ def vbiview(chunker, config, pause):
 
         Line.configure(config, force_cpu=True)
 
-        chunks = chunker(config.line_length * np.dtype(config.dtype).itemsize, config.field_lines, config.field_range)
+        chunks = chunker(config.line_length * np.dtype(config.dtype).itemsize, config.field_lines, config.field_range, memmap=True)
 
         lines = (Line(chunk, number) for number, chunk in chunks)
 
@@ -280,32 +292,131 @@ def vbiview(chunker, config, pause):
 
 
 @command(teletext)
-@click.option('-M', '--mode', type=click.Choice(['deconvolve', 'slice']), default='deconvolve', help='Deconvolution mode.')
+@click.option('-M', '--mode', type=click.Choice(['deconvolve', 'slice', 'hybrid']), default='deconvolve', help='Deconvolution mode.')
+@click.option('--hybrid-threshold', type=click.IntRange(min=0), default=0, help='In hybrid mode, deconvolve sliced packets with more than N bytes with errors.')
 @click.option('-C', '--force-cpu', is_flag=True, help='Disable CUDA even if it is available.')
 @click.option('-t', '--threads', type=int, default=multiprocessing.cpu_count(), help='Number of threads.')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=16, help='Number of lines to process together.')
+@click.option('--search', type=click.Choice(['brute', 'kdtree']), default='brute', help='Pattern search method.')
+@click.option('--approx', type=click.FloatRange(min=0), default=0, help='Allow kdtree matches up to (1+N) times the closest distance.')
+@click.option('--shared-tables/--no-shared-tables', default=True, help='Share one copy of the pattern tables between all threads.')
+@click.option('--shards/--no-shards', default=True, help='Let threads read their own lines from regular input files.')
+@click.option('--ring-size', type=click.IntRange(min=0), default=0, help='Pass lines and results to threads through shared memory ring buffers of N MiB. Default: off.')
+@click.option('--transport', type=click.Choice(['ipc', 'tcp']), default='ipc', help='How to connect to threads. ipc falls back to tcp where it is not available.')
+@click.option('--listen', type=str, default=None, help='Let other machines join with the worker command at [HOST:]PORT. Only use on trusted networks.')
+@click.option('--start-method', type=click.Choice(['forkserver', 'spawn', 'fork']), default=None, help='How to start threads. Default: forkserver on Linux, spawn elsewhere.')
+@click.option('--retries', type=click.IntRange(min=0), default=3, help='Times to retry lines which crash a thread before skipping them.')
+@click.option('--latency', type=click.FloatRange(min=0), default=None, help='Size chunks of work so threads return results within N seconds. Default: size for throughput, or max-lag/4 in realtime mode.')
+@click.option('--realtime', is_flag=True, help='Slice lines instead when decoding falls behind a live capture.')
+@click.option('--max-lag', type=click.FloatRange(min=0), default=1.0, help='Seconds of lag allowed in realtime mode before lines are downgraded.')
+@click.option('-p', '--page', 'pages', type=str, multiple=True, help='Only decode rows of specific pages. Can be specified multiple times.')
+@click.option('-s', '--subpage', 'subpages', type=str, multiple=True, help='Only decode rows of specific subpages. Can be specified multiple times.')
 @carduser(extended=True)
 @packetwriter
 @chunkreader
 @filterparams
 @progressparams(progress=True, mag_hist=True)
 @click.option('--rejects/--no-rejects', default=True, help='Display percentage of lines rejected.')
-def deconvolve(chunker, mags, rows, config, mode, force_cpu, threads, progress, mag_hist, row_hist, err_hist, rejects):
+def deconvolve(chunker, mags, rows, config, mode, hybrid_threshold, force_cpu, threads, batch_size, search, approx, shared_tables, shards, ring_size, transport, listen, start_method, retries, latency, realtime, max_lag, pages, subpages, progress, mag_hist, row_hist, err_hist, rejects):
 
     """Deconvolve raw VBI samples into Teletext packets."""
 
-    from teletext.vbi.line import process_lines
+    from teletext.vbi.line import Line, process_lines, process_blocks
+    from teletext.vbi.pattern import SharedTables
+    from teletext.vbi.realtime import Scheduler
+    from teletext.vbi.pagetracker import PageTracker
 
     if force_cpu:
         sys.stderr.write('CUDA disabled by user request.\n')
 
-    chunks = chunker(config.line_length * np.dtype(config.dtype).itemsize, config.field_lines, config.field_range)
+    if approx and search == 'brute':
+        raise click.UsageError('--approx requires an indexed --search method.')
+
+    if listen is not None:
+        if ring_size:
+            raise click.UsageError('--listen can not be used with --ring-size.')
+        # Other machines can't read the input or the shared tables.
+        shards = shared_tables = False
+
+    size = config.line_length * np.dtype(config.dtype).itemsize
+    if batch_size > 1:
+        items = chunker(size, config.field_lines, config.field_range, memmap=True, block=batch_size, shards=shards and threads > 1)
+    else:
+        items = chunker(size, config.field_lines, config.field_range, memmap=True)
+    source = getattr(items, 'source', None)
 
     if progress:
-        chunks = tqdm(chunks, unit='L', dynamic_ncols=True)
-        if any((mag_hist, row_hist, rejects)):
+        if batch_size > 1:
+            chunks = tqdm(total=getattr(items, 'lines', None), unit='L', dynamic_ncols=True)
+            items = blockprogress(items, chunks)
+        else:
+            items = chunks = tqdm(items, unit='L', dynamic_ncols=True)
+        if any((mag_hist, row_hist, rejects, realtime, chunker.readahead, threads > 1, listen)):
             chunks.postfix = StatsList()
+        if chunker.readahead is not None:
+            chunks.postfix.append(chunker.readahead)
+
+    kwargs = dict(mode=mode, config=config, force_cpu=force_cpu, mags=mags, rows=rows, search=search, eps=approx, threshold=hybrid_threshold)
+
+    if source is not None:
+        # Blocks are only line numbers. Workers read the lines themselves.
+        kwargs['source'] = source
+
+    if pages or subpages:
+        tracker = PageTracker(
+            {int(x, 16) for x in pages} if pages else range(0x900),
+            {int(x, 16) for x in subpages} if subpages else range(0x3f80),
+        )
+        # Workers need the headers to follow the pages. Rows they can't
+        # place are removed by tracker.filter once results are in order.
+        kwargs.update(pages=tracker, rows=set(rows) | {0})
+    else:
+        tracker = None
+
+    if ring_size:
+        kwargs['ring_size'] = ring_size << 20
+    kwargs['transport'] = transport
+    kwargs['start_method'] = start_method
+    kwargs['retries'] = retries
+    if listen is not None:
+        kwargs['listen'] = listen
+
+    if realtime and latency is None:
+        latency = max_lag / 4
+    sizer = ChunkSizer(latency)
+
+    if progress and (threads > 1 or listen is not None):
+        chunks.postfix.append(sizer)
+
+    def run(function, items):
+        with contextlib.ExitStack() as stack:
+            if shared_tables and threads > 1 and mode != 'slice':
+                tables = stack.enter_context(SharedTables(Line.pattern_files()))
+                kwargs['shared'] = tables.descriptor
+            pool = stack.enter_context(PureGeneratorPool(function, threads, **kwargs))
+            if progress and getattr(pool, 'startup', None) is not None:
+                # Show how long the threads took to start.
+                chunks.postfix.append(pool)
+            yield from pool.apply(items, sizer)
+            for chunk in getattr(pool, 'poisoned', ()):
+                numbers = np.hstack([(item[1] if realtime else item)[0] for item in chunk])
+                sys.stderr.write(f'Skipped lines {numbers.min()}-{numbers.max()}: they crashed a thread {retries + 1} times.\n')
+
+    if realtime:
+        # The capture produces 50 fields per second.
+        scheduler = Scheduler(mode, 50 * len(config.field_range), max_lag, batch_size)
+        items = scheduler.schedule(items)
+        kwargs['scheduled'] = True
+        if progress:
+            chunks.postfix.append(scheduler)
+
+    if batch_size > 1:
+        packets = itertools.chain.from_iterable(run(process_blocks, items))
+    else:
+        packets = run(process_lines, items)
 
-    packets = itermap(process_lines, chunks, threads, mode=mode, config=config, force_cpu=force_cpu, mags=mags, rows=rows)
+    if realtime:
+        packets = scheduler.report(packets)
 
     if progress and rejects:
         packets = Rejects(packets)
@@ -313,6 +424,9 @@ def deconvolve(chunker, mags, rows, config, mode, force_cpu, threads, progress,
 
     packets = (p for p in packets if isinstance(p, Packet))
 
+    if tracker is not None:
+        packets = tracker.filter(packets, rows)
+
     if progress and mag_hist:
         packets = MagHistogram(packets)
         chunks.postfix.append(packets)
@@ -326,6 +440,172 @@ def deconvolve(chunker, mags, rows, config, mode, force_cpu, threads, progress,
     return packets
 
 
+@command(teletext)
+@click.option('-a', '--address', type=str, default=None, help='zmq address to listen on. Default: a socket in the user\'s runtime directory.')
+@click.option('-C', '--force-cpu', is_flag=True, help='Disable CUDA even if it is available.')
+@click.option('-t', '--threads', type=int, default=multiprocessing.cpu_count(), help='Number of threads.')
+@click.option('--search', type=click.Choice(['brute', 'kdtree']), default='brute', help='Pattern search method.')
+@click.option('--approx', type=click.FloatRange(min=0), default=0, help='Allow kdtree matches up to (1+N) times the closest distance.')
+@click.option('--shared-tables/--no-shared-tables', default=True, help='Share one copy of the pattern tables between all threads.')
+@click.option('--transport', type=click.Choice(['ipc', 'tcp']), default='ipc', help='How to connect to threads. ipc falls back to tcp where it is not available.')
+@click.option('--start-method', type=click.Choice(['forkserver', 'spawn', 'fork']), default=None, help='How to start threads. Default: forkserver on Linux, spawn elsewhere.')
+def serve(address, force_cpu, threads, search, approx, shared_tables, transport, start_method):
+
+    """Keep threads running to deconvolve jobs sent with submit."""
+
+    from teletext.serve import Server, default_address
+
+    if approx and search == 'brute':
+        raise click.UsageError('--approx requires an indexed --search method.')
+
+    if address is None:
+        address = default_address()
+
+    with Server(address, threads, force_cpu, search, approx, shared_tables, transport, start_method=start_method) as server:
+        if server.startup is not None:
+            sys.stderr.write(f'Started {threads} threads in {server.startup:.2f}s.\n')
+        sys.stderr.write(f'Listening on {address} with {threads} threads.\n')
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        sys.stderr.write(f'Served {server.served} jobs.\n')
+
+
+@command(teletext)
+@click.option('-a', '--address', type=str, default=None, help='zmq address of the server. Default: a socket in the user\'s runtime directory.')
+@click.option('-M', '--mode', type=click.Choice(['deconvolve', 'slice', 'hybrid']), default='deconvolve', help='Deconvolution mode.')
+@click.option('--hybrid-threshold', type=click.IntRange(min=0), default=0, help='In hybrid mode, deconvolve sliced packets with more than N bytes with errors.')
+@click.option('-b', '--batch-size', type=click.IntRange(min=1), default=16, help='Number of lines to process together.')
+@click.option('--shards/--no-shards', default=True, help='Let the server read lines from regular input files itself.')
+@carduser(extended=True)
+@packetwriter
+@chunkreader
+@filterparams
+@progressparams(progress=True, mag_hist=True)
+@click.option('--rejects/--no-rejects', default=True, help='Display percentage of lines rejected.')
+def submit(chunker, address, mags, rows, config, mode, hybrid_threshold, batch_size, shards, progress, mag_hist, row_hist, err_hist, rejects):
+
+    """Deconvolve raw VBI samples with a running serve command."""
+
+    from teletext.serve import submit, default_address
+
+    if address is None:
+        address = default_address()
+
+    size = config.line_length * np.dtype(config.dtype).itemsize
+    items = chunker(size, config.field_lines, config.field_range, memmap=True, block=batch_size, shards=shards)
+    source = getattr(items, 'source', None)
+    if source is not None:
+        # The server may not be running in the same directory.
+        source.name = os.path.abspath(source.name)
+
+    if progress:
+        chunks = tqdm(total=getattr(items, 'lines', None), unit='L', dynamic_ncols=True)
+        items = blockprogress(items, chunks)
+        chunks.postfix = StatsList()
+        if chunker.readahead is not None:
+            chunks.postfix.append(chunker.readahead)
+
+    job = dict(config=config, mode=mode, mags=mags, rows=rows, threshold=hybrid_threshold, source=source)
+    try:
+        packets = itertools.chain.from_iterable(submit(address, job, items))
+
+        if progress and rejects:
+            packets = Rejects(packets)
+            chunks.postfix.append(packets)
+
+        packets = (p for p in packets if isinstance(p, Packet))
+
+        if progress and mag_hist:
+            packets = MagHistogram(packets)
+            chunks.postfix.append(packets)
+        if progress and row_hist:
+            packets = RowHistogram(packets)
+            chunks.postfix.append(packets)
+        if progress and err_hist:
+            packets = ErrorHistogram(packets)
+            chunks.postfix.append(packets)
+
+        yield from packets
+    except (ConnectionError, ChildProcessError) as e:
+        raise click.ClickException(str(e))
+
+
+@command(teletext)
+@click.option('--connect', type=str, required=True, help='HOST:PORT given to --listen on the machine running deconvolve.')
+@click.option('-t', '--threads', type=int, default=multiprocessing.cpu_count(), help='Number of threads.')
+@click.option('--once', is_flag=True, help='Exit after one run instead of waiting for the next.')
+@click.option('--start-method', type=click.Choice(['forkserver', 'spawn', 'fork']), default=None, help='How to start threads. Default: forkserver on Linux, spawn elsewhere.')
+def worker(connect, threads, once, start_method):
+
+    """Lend threads to deconvolve running on another machine."""
+
+    from teletext.mp import remote
+
+    sys.stderr.write(f'Joining {connect} with {threads} threads.\n')
+    try:
+        remote(connect, threads, once, start_method)
+    except KeyboardInterrupt:
+        pass
+
+
+@teletext.group()
+def vbi():
+    """Tools for raw VBI files."""
+    pass
+
+
+@command(vbi)
+@click.argument('input', type=click.Path(exists=True, dir_okay=False), required=True)
+def index(input):
+    """Build a block index so a compressed file can be seeked and split."""
+    from teletext.compression import detect, build_index, index_name
+
+    with open(input, 'rb') as f:
+        fmt = detect(f)
+        if fmt is None:
+            raise click.UsageError(f'{input} is not compressed.')
+        idx = build_index(f, fmt)
+
+    with open(index_name(input), 'wb') as f:
+        np.save(f, idx)
+
+    sys.stderr.write(f'{len(idx) - 1} members, {idx[-1, 1]} bytes uncompressed.\n')
+    if len(idx) == 2:
+        sys.stderr.write('Only one member: seeking will decompress from the start of the file.\n')
+
+
+@command(vbi)
+@click.argument('input', type=click.File('rb'), default='-')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--codec', type=click.Choice(['zlib', 'bz2', 'xz']), default='zlib', help='Compressor for each block. Default: zlib.')
+@click.option('--level', type=click.IntRange(0, 9), default=6, help='Compression level. Default: 6.')
+@click.option('--block-frames', type=click.IntRange(min=1), default=25, help='Number of frames in each block. Default: 25.')
+@carduser()
+def pack(input, output, codec, level, block_frames, config):
+    """Losslessly compress raw VBI samples into a seekable archive."""
+    from teletext.archive import pack
+
+    size = config.line_length * np.dtype(config.dtype).itemsize
+    with tqdm.wrapattr(input, 'read', unit='B', unit_scale=True, dynamic_ncols=True) as i:
+        writer = pack(i, output, size, np.dtype(config.dtype).itemsize, config.field_lines * 2, block_frames, codec, level)
+
+    dropped = np.count_nonzero(np.diff(writer.sequence.astype(np.int64)) != 1)
+    sys.stderr.write(f'{len(writer.sequence)} frames, {writer.compressed / max(writer.size, 1):.1%} of original size.\n')
+    if dropped:
+        sys.stderr.write(f'Frame drop? {dropped}\n')
+
+
+@command(vbi)
+@click.argument('input', type=click.File('rb'), default='-')
+@click.argument('output', type=click.File('wb'), default='-')
+def unpack(input, output):
+    """Restore raw VBI samples from an archive."""
+    from teletext.archive import unpack
+    unpack(input, output)
+
+
 @teletext.group()
 def training():
     """Training and calibration tools."""
@@ -351,12 +631,13 @@ def split(chunker, outdir, config, threads, progress, rejects):
     """Split training recording into intermediate bins."""
     from teletext.vbi.training import process_training, split
 
-    chunks = chunker(config.line_length * np.dtype(config.dtype).itemsize, config.field_lines, config.field_range)
+    chunks = chunker(config.line_length * np.dtype(config.dtype).itemsize, config.field_lines, config.field_range, memmap=True)
 
     if progress:
         chunks = tqdm(chunks, unit='L', dynamic_ncols=True)
 
-    results = itermap(process_training, chunks, threads, config=config)
+    # The bins are sorted when they are squashed, so take results as they come.
+    results = (r for _, r in itermap(process_training, chunks, threads, ordered=False, config=config))
 
     if progress and rejects:
         results = Rejects(results)
@@ -6,10 +6,11 @@ from functools import wraps
 import click
 from tqdm import tqdm
 
-from . import pipeline
+from . import pageindex, pipeline
 from .packet import Packet
 from .stats import StatsList, MagHistogram, RowHistogram, ErrorHistogram
-from .file import FileChunker
+from .compression import decompressing
+from .file import FileChunker, ReadAhead
 from .vbi.config import Config
 
 try:
@@ -68,8 +69,10 @@ def chunkreader(f):
     @click.option('--stop', type=int, default=None, help='Stop before the Nth line of the input file.')
     @click.option('--step', type=int, default=1, help='Process every Nth line from the input file.')
     @click.option('--limit', type=int, default=None, help='Stop after processing N lines from the input file.')
+    @click.option('--read-ahead/--no-read-ahead', default=True, help='Read unseekable input in a background thread.')
+    @click.option('--format', 'fmt', type=click.Choice(['auto', 'raw', 'archive', 'gzip', 'bz2', 'xz']), default='auto', help='Input format. Default: tell from the start of the input.')
     @wraps(f)
-    def wrapper(input, start, stop, step, limit, *args, **kwargs):
+    def wrapper(input, start, stop, step, limit, read_ahead, fmt, *args, **kwargs):
 
         if input.isatty():
             raise click.UsageError('No input file and stdin is a tty - exiting.', )
@@ -78,13 +81,40 @@ def chunkreader(f):
             if hasattr(input, 'fileno') and stat.S_ISFIFO(os.fstat(input.fileno()).st_mode):
                 kwargs['progress'] = False
 
-        chunker = lambda size, flines=16, frange=range(0, 16): FileChunker(input, size, start, stop, step, limit, flines, frange)
+        input = decompressing(input, fmt)
+        if read_ahead and not input.seekable():
+            input = ReadAhead(input)
+
+        chunker = lambda size, flines=16, frange=range(0, 16), memmap=False, block=None, shards=False, numbers=None: FileChunker(input, size, start, stop, step, limit, flines, frange, memmap, block, shards, numbers)
+        # Commands can show how full the read ahead buffer is, or look for
+        # an index of the input.
+        chunker.readahead = input if isinstance(input, ReadAhead) else None
+        chunker.input = input
+        chunker.start = start
+        chunker.step = step
 
         return f(chunker=chunker, *args, **kwargs)
     return wrapper
 
 
-def packetreader(f):
+def blockprogress(blocks, bar):
+    """Update a tqdm bar with the number of lines in each (numbers, lines) block."""
+    for block in blocks:
+        bar.update(len(block[0]))
+        yield block
+    bar.close()
+
+
+def packetreader(f=None, headers=False):
+    """Read t42 packets from the input.
+
+    If the input has a page index from `teletext index`, only the packets
+    needed to find the pages selected by paginated() are read, or only the
+    headers if headers is True.
+    """
+    if f is None:
+        return lambda f: packetreader(f, headers)
+
     @chunkreader
     @click.option('--wst', is_flag=True, default=False, help='Input is 43 bytes per packet (WST capture card format.)')
     @filterparams
@@ -92,9 +122,18 @@ def packetreader(f):
     @wraps(f)
     def wrapper(chunker, wst, mags, rows, progress, mag_hist, row_hist, err_hist, *args, **kwargs):
 
+        pages = kwargs.get('pages', range(0x900))
+        subpages = kwargs.get('subpages', range(0x3f80))
+        index = None
+        if not wst and (headers or pages != range(0x900) or subpages != range(0x3f80)):
+            index = pageindex.load(chunker.input)
+
         if wst:
             chunks = chunker(43)
             chunks = ((c[0],c[1][:42]) for c in chunks if c[1][0] != 0)
+        elif index is not None:
+            numbers = pageindex.select(chunker.input, index, pages, subpages, headers, chunker.start, chunker.step)
+            chunks = chunker(42, numbers=numbers)
         else:
             chunks = chunker(42)
 
@@ -103,8 +142,10 @@ def packetreader(f):
 
         if progress:
             chunks = tqdm(chunks, unit='P', dynamic_ncols=True)
-            if any((mag_hist, row_hist)):
+            if any((mag_hist, row_hist, chunker.readahead)):
                 chunks.postfix = StatsList()
+            if chunker.readahead is not None:
+                chunks.postfix.append(chunker.readahead)
 
         packets = (Packet(data, number) for number, data in chunks)
         packets = (p for p in packets if p.mrag.magazine in mags and p.mrag.row in rows)
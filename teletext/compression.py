@@ -0,0 +1,213 @@
+import bz2
+import io
+import lzma
+import os
+import re
+import zlib
+
+import numpy as np
+
+from .file import BlockReader
+
+
+# Patterns matching the start of each supported format, and decompressor
+# factories. bz2 is matched up to the magic of its first block, as 'BZh'
+# alone is likely to turn up at the start of raw samples.
+formats = {
+    'gzip': (re.compile(b'\x1f\x8b'), lambda: zlib.decompressobj(wbits=31)),
+    'bz2': (re.compile(b'BZh[1-9]1AY&SY'), bz2.BZ2Decompressor),
+    'xz': (re.compile(b'\xfd7zXZ\x00'), lambda: lzma.LZMADecompressor(format=lzma.FORMAT_XZ)),
+}
+
+
+def detect(f):
+    """Return the compression format of buffered binary file f, or None."""
+    try:
+        head = f.peek(10)[:10]
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return None
+    for fmt, (magic, _) in formats.items():
+        if magic.match(head):
+            return fmt
+    return None
+
+
+def index_name(name):
+    """The name of the block index sidecar for a compressed file."""
+    return name + '.blocks.npy'
+
+
+def build_index(f, fmt, bufsize=1<<20):
+    """Find where each member of a compressed file starts.
+
+    gzip files can contain several members, and bz2 and xz files several
+    streams, each of which can be decompressed on its own. Tools like
+    bgzip and pbzip2 write files this way. Returns an (N+1, 2) array of
+    (compressed offset, uncompressed offset) for each member, followed
+    by the total compressed and uncompressed sizes.
+    """
+    new = formats[fmt][1]
+    index = []
+    coffset = 0
+    uoffset = 0
+    d = None
+    data = b''
+    while True:
+        if not data:
+            data = f.read(bufsize)
+            if not data:
+                break
+        if d is None:
+            # xz streams may be followed by padding.
+            stripped = data.lstrip(b'\0')
+            coffset += len(data) - len(stripped)
+            data = stripped
+            if not data:
+                continue
+            index.append((coffset, uoffset))
+            d = new()
+        uoffset += len(d.decompress(data))
+        if d.eof:
+            coffset += len(data) - len(d.unused_data)
+            data = d.unused_data
+            d = None
+        else:
+            coffset += len(data)
+            data = b''
+    index.append((coffset, uoffset))
+    return np.array(index, dtype=np.int64)
+
+
+def load_index(name):
+    """Load the block index sidecar for a compressed file, if it exists and
+    matches the file."""
+    try:
+        index = np.load(index_name(name))
+    except (OSError, ValueError):
+        return None
+    if index.ndim != 2 or index.shape[1] != 2 or index[-1, 0] != os.stat(name).st_size:
+        return None
+    return index
+
+
+class CompressedFile(BlockReader):
+
+    """
+    Read-only file object which decompresses another file.
+
+    Without an index it can only be read from start to end. With an index
+    from build_index it knows its uncompressed size and can seek to any
+    position, by decompressing from the start of the member containing it.
+    """
+
+    def __init__(self, fileobj, fmt, index=None, name=None):
+        self._fileobj = fileobj
+        self._new = formats[fmt][1]
+        self._index = index
+        self.fmt = fmt
+        self.name = name
+        # fileobj might be a pipe, so don't seek until asked to.
+        self._pos = 0
+        self._reset()
+
+    def _restart(self, member):
+        """Start decompressing at the start of a member."""
+        if self._index is None:
+            self._fileobj.seek(0)
+            self._pos = 0
+        else:
+            self._fileobj.seek(int(self._index[member, 0]))
+            self._pos = int(self._index[member, 1])
+        self._reset()
+
+    def _reset(self):
+        super()._reset()
+        self._decompressor = None
+        self._input = b''
+
+    def _fill(self):
+        """Decompress more data into the empty buffer. Returns False at EOF."""
+        while True:
+            if not self._input:
+                self._input = self._fileobj.read(1<<16)
+                if not self._input:
+                    return False
+            if self._decompressor is None:
+                # xz streams may be followed by padding.
+                self._input = self._input.lstrip(b'\0')
+                if not self._input:
+                    continue
+                self._decompressor = self._new()
+            data = self._decompressor.decompress(self._input)
+            if self._decompressor.eof:
+                self._input = self._decompressor.unused_data
+                self._decompressor = None
+            else:
+                self._input = b''
+            if data:
+                self._buffer = data
+                self._offset = 0
+                return True
+
+    @property
+    def members(self):
+        """The number of separately decompressible members, if known."""
+        return 0 if self._index is None else len(self._index) - 1
+
+    def seekable(self):
+        return self._index is not None
+
+    def fileno(self):
+        raise io.UnsupportedOperation('fileno')
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            if self._index is None:
+                raise io.UnsupportedOperation('Compressed file has no block index.')
+            offset += int(self._index[-1, 1])
+        if self._index is not None:
+            member = max(np.searchsorted(self._index[:-1, 1], offset, side='right') - 1, 0)
+            if offset < self._pos or self._index[member, 1] > self._pos:
+                self._restart(member)
+        elif offset < self._pos:
+            self._restart(0)
+        self._take(offset - self._pos, keep=False)
+        return self._pos
+
+    def reopen(self):
+        """Open another CompressedFile on the same file, for another process."""
+        return open_compressed(self.name)
+
+
+def open_compressed(name):
+    """Open a compressed file or VBI archive by name, with its block index
+    if there is one."""
+    return decompressing(open(name, 'rb'))
+
+
+def decompressing(f, fmt='auto'):
+    """Wrap a binary file in a CompressedFile if it is compressed, or an
+    ArchiveFile if it is a VBI archive.
+
+    fmt is 'auto' to tell from the start of the file, 'raw' to return the
+    file as it is, 'archive', or one of the compression formats.
+
+    Named files get their block index, if one has been built for them.
+    """
+    from .archive import ArchiveFile, is_archive
+    if fmt == 'raw':
+        return f
+    name = getattr(f, 'name', None)
+    if not (isinstance(name, str) and os.path.isfile(name)):
+        name = None
+    if fmt == 'archive' or (fmt == 'auto' and is_archive(f)):
+        return ArchiveFile(f, name)
+    if fmt == 'auto':
+        fmt = detect(f)
+    if fmt is None:
+        return f
+    if name is not None:
+        return CompressedFile(f, fmt, load_index(name), name)
+    return CompressedFile(f, fmt)
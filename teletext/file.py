@@ -1,7 +1,12 @@
 import io
 import itertools
+import mmap
 import os
+import queue
 import stat
+import threading
+
+import numpy as np
 
 
 def PossiblyInfiniteRange(start=0, stop=None, step=1, limit=None):
@@ -18,9 +23,10 @@ def PossiblyInfiniteRange(start=0, stop=None, step=1, limit=None):
 
 
 class LenWrapper(object):
-    def __init__(self, i, l):
+    def __init__(self, i, l, lines=None):
         self.i = i
         self.l = l
+        self.lines = l if lines is None else lines
 
     def __iter__(self):
         return self.i
@@ -58,10 +64,279 @@ def chunks(f, size, start, step, flines=16, frange=(0, 16), seek=True):
     except StopIteration:
         return
 
-def FileChunker(f, size, start=0, stop=None, step=1, limit=None, flines=16, frange=range(0, 16)):
+class BlockReader(io.BufferedIOBase):
+
+    """
+    Base for read-only file objects which produce data a block at a time.
+
+    Subclasses implement _fill(), which puts the next block in _buffer and
+    returns True, or returns False at the end of the data.
+    """
+
+    def _reset(self):
+        self._buffer = b''
+        self._offset = 0
+
+    def _take(self, size, keep=True):
+        """Consume up to size bytes, or everything if size is negative."""
+        parts = []
+        while size:
+            available = len(self._buffer) - self._offset
+            if available == 0:
+                if not self._fill():
+                    break
+                continue
+            n = available if size < 0 else min(size, available)
+            if keep:
+                parts.append(self._buffer[self._offset:self._offset+n])
+            self._offset += n
+            self._pos += n
+            if size > 0:
+                size -= n
+        return b''.join(parts)
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        return self._take(-1 if size is None else size)
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class ReadAhead(BlockReader):
+
+    """
+    Reads an unseekable file in a background thread.
+
+    Up to depth reads of up to bufsize bytes are kept in a queue, so that
+    reading a pipe overlaps with whatever the main thread does with the
+    data. Converting to str gives the occupancy of the queue, for progress
+    bars.
+    """
+
+    label = 'B'
+
+    def __init__(self, f, bufsize=1<<20, depth=16):
+        self._f = f
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._pos = 0
+        self._reset()
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, args=(bufsize, ), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, bufsize):
+        read = getattr(self._f, 'read1', self._f.read)
+        try:
+            while True:
+                data = read(bufsize)
+                if not self._put(data) or not data:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._queue.get()
+        if isinstance(data, Exception):
+            self._eof = True
+            raise data
+        if not data:
+            self._eof = True
+            return False
+        self._buffer = data
+        self._offset = 0
+        return True
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+    @property
+    def occupancy(self):
+        """The fraction of the queue which is full."""
+        return self._queue.qsize() / self._queue.maxsize
+
+    def __str__(self):
+        return f', {self.label}:{100*self.occupancy:.0f}%'
+
+
+def _mappable(f):
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return False
+
+
+def _map_lines(f, size):
+    """A read-only (lines, size) array backed by a memory map of f."""
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    total_lines = len(m) // size
+    return np.frombuffer(m, dtype=np.uint8, count=total_lines * size).reshape(total_lines, size)
+
+
+def mapped_chunks(f, size, numbers, flines=16, frange=range(0, 16)):
+    """Yield the lines in numbers as numpy views into a memory map of f.
+
+    Line numbers count only the lines in frange, as they do for chunks().
+    """
+    lines = _map_lines(f, size)
+    for n in numbers:
+        field, line = divmod(n, len(frange))
+        yield lines[(field * flines) + frange.start + line]
+
+
+def _line_index(numbers, flines, frange):
+    """The positions in the file of the lines in the array numbers."""
+    field, line = np.divmod(numbers, len(frange))
+    return (field * flines) + frange.start + line
+
+
+def _gather(lines, numbers, flines, frange):
+    """Select the lines in the array numbers from all the lines of a file.
+
+    Adjacent lines are returned as a view. Lines which skip some because
+    of step or frange are gathered into a new array.
+    """
+    idx = _line_index(numbers, flines, frange)
+    if idx[-1] - idx[0] == len(idx) - 1:
+        return lines[idx[0]:idx[-1]+1]
+    else:
+        return lines[idx]
+
+
+def mapped_blocks(f, size, numbers, block, flines=16, frange=range(0, 16)):
+    """Yield (numbers, lines) for each block of numbers from a memory map of f."""
+    lines = _map_lines(f, size)
+    numbers = iter(numbers)
+    while True:
+        n = np.fromiter(itertools.islice(numbers, block), dtype=np.int64)
+        if len(n) == 0:
+            return
+        yield n, _gather(lines, n, flines, frange)
+
+
+class MappedLines(object):
+
+    """Reads lines from a file by name, so that worker processes can each
+    read their own part of it instead of being sent the lines. The file is
+    mapped the first time it is read, in the process reading it."""
+
+    def __init__(self, name, size, flines=16, frange=range(0, 16)):
+        self.name = name
+        self.size = size
+        self.flines = flines
+        self.frange = frange
+        self._lines = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lines'] = None
+        return state
+
+    def read(self, numbers):
+        """The lines in numbers, as a (len(numbers), size) array."""
+        if self._lines is None:
+            with open(self.name, 'rb') as f:
+                self._lines = _map_lines(f, self.size)
+        return _gather(self._lines, np.asarray(numbers), self.flines, self.frange)
+
+
+class CompressedLines(MappedLines):
+
+    """Reads lines from a compressed file with a block index by name.
+
+    Each read decompresses from the start of the member containing the
+    first line, so this is only worth using on files with many members.
+    """
+
+    def read(self, numbers):
+        """The lines in numbers, as a (len(numbers), size) array."""
+        if self._lines is None:
+            from .compression import open_compressed
+            self._lines = open_compressed(self.name)
+        idx = _line_index(np.asarray(numbers), self.flines, self.frange)
+        self._lines.seek(int(idx[0]) * self.size)
+        data = self._lines.read(int(idx[-1] - idx[0] + 1) * self.size)
+        lines = np.frombuffer(data, dtype=np.uint8).reshape(-1, self.size)
+        return lines[idx - idx[0]]
+
+
+def blocks(chunks, size, block):
+    """Group (number, bytes) chunks into (numbers, lines) blocks."""
+    chunks = iter(chunks)
+    while True:
+        c = list(itertools.islice(chunks, block))
+        if len(c) == 0:
+            return
+        yield (
+            np.fromiter((n for n, _ in c), dtype=np.int64, count=len(c)),
+            np.frombuffer(b''.join(b for _, b in c), dtype=np.uint8).reshape(len(c), size),
+        )
+
+
+def _fifo(f):
+    try:
+        return stat.S_ISFIFO(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return False
+
+
+def _named(f):
+    """Whether f can be opened again by name."""
+    try:
+        return isinstance(f.name, str) and os.path.samestat(os.fstat(f.fileno()), os.stat(f.name))
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return False
+
+
+def FileChunker(f, size, start=0, stop=None, step=1, limit=None, flines=16, frange=range(0, 16), memmap=False, block=None, shards=False, numbers=None):
+    """Yield (number, line) for lines of size bytes from f.
+
+    If memmap is True and f is a non-empty regular file, lines are numpy
+    views into a read-only memory map of it instead of bytes, so reading
+    them costs no system calls or copies.
+
+    If block is given, yield (numbers, lines) instead, where numbers is an
+    array of up to block line numbers and lines is a (len(numbers), size)
+    uint8 array holding those lines. The length is the number of blocks,
+    and the lines attribute is the number of lines.
+
+    If shards is also True and f is a regular file which can be opened
+    by name, lines is None and numbers is a range. The source attribute
+    is then a MappedLines which reads the lines for those numbers, and can
+    be sent to other processes cheaply. Compressed files with a block
+    index of more than one member are split the same way, using a
+    CompressedLines source.
+
+    If numbers is given, only the lines with those numbers are read, in
+    order. Regular files are read directly from a memory map, and other
+    files by skipping the rest of the lines. Blocks are not supported.
+    """
     seekable = False
     try:
-        if hasattr(f, 'fileno') and stat.S_ISFIFO(os.fstat(f.fileno()).st_mode):
+        if _fifo(f):
             raise io.UnsupportedOperation
 
         f.seek(0, os.SEEK_END)
@@ -79,10 +354,48 @@ def FileChunker(f, size, start=0, stop=None, step=1, limit=None, flines=16, fran
         f.seek(0, os.SEEK_SET)
 
     except io.UnsupportedOperation:
-        f.read(size * start)
+        pass
 
     r = PossiblyInfiniteRange(start, stop, step, limit)
-    i = zip(r, chunks(f, size, start, step, flines, frange, seek=seekable))
+    mappable = seekable and useful_lines > 0 and _mappable(f)
+    mapped = memmap and mappable
+    if numbers is not None:
+        numbers = np.asarray(numbers, dtype=np.int64)
+        keep = (numbers >= start) & ((numbers - start) % step == 0)
+        if hasattr(r, '__len__'):
+            keep &= numbers < r.stop
+        numbers = numbers[keep]
+        if mappable:
+            i = zip(numbers.tolist(), mapped_chunks(f, size, numbers, flines, frange))
+            if not memmap:
+                i = ((n, l.tobytes()) for n, l in i)
+        else:
+            wanted = set(numbers.tolist())
+            i = ((n, c) for n, c in zip(r, chunks(f, size, start, step, flines, frange, seek=seekable)) if n in wanted)
+        return LenWrapper(i, len(numbers))
+    if block is not None:
+        if mapped and shards and _named(f):
+            i = ((r[n:n+block], None) for n in range(0, len(r), block))
+            w = LenWrapper(i, -(-len(r) // block), len(r))
+            w.source = MappedLines(f.name, size, flines, frange)
+            return w
+        elif shards and seekable and getattr(f, 'members', 0) > 1 and f.name is not None:
+            i = ((r[n:n+block], None) for n in range(0, len(r), block))
+            w = LenWrapper(i, -(-len(r) // block), len(r))
+            w.source = CompressedLines(f.name, size, flines, frange)
+            return w
+        elif mapped:
+            i = mapped_blocks(f, size, r, block, flines, frange)
+        else:
+            i = blocks(zip(r, chunks(f, size, start, step, flines, frange, seek=seekable)), size, block)
+        if hasattr(r, '__len__'):
+            return LenWrapper(i, -(-len(r) // block), len(r))
+        else:
+            return i
+    if mapped:
+        i = zip(r, mapped_chunks(f, size, r, flines, frange))
+    else:
+        i = zip(r, chunks(f, size, start, step, flines, frange, seek=seekable))
     if hasattr(r, '__len__'):
         return LenWrapper(i, len(r))
     else:
@@ -1,16 +1,180 @@
 import atexit
+import collections
 import itertools
+import os
 import pickle
+import platform
 import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
+import numpy as np
 import zmq
 
 
-def denumerate(work, control, tmp_queue):
+class RingBuffer(object):
 
-    """Strips sequence numbers from work_queue items and yields the work."""
+    """
+    Space in a shared memory segment, handed out and released in order.
+
+    The segment starts with a header holding how many bytes have ever been
+    released. Only the process which allocates may write data, and only
+    one process may release, so a worker can allocate results while the
+    parent releases them as it reads them.
+    """
+
+    HEADER = 64
+    ALIGN = 64
+
+    def __init__(self, size, name=None):
+        self.size = size
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size + self.HEADER)
+        else:
+            # Only the parent may unlink the segment.
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self.data = self._shm.buf[self.HEADER:self.HEADER + size]
+        self._released = np.ndarray((1, ), dtype=np.int64, buffer=self._shm.buf)
+        self._allocated = 0
+
+    def alloc(self, nbytes):
+        """Allocate nbytes contiguous bytes. Returns (offset, end) or None if
+        there isn't room. Releasing up to end frees them again."""
+        nbytes = -(-nbytes // self.ALIGN) * self.ALIGN
+        pos = self._allocated % self.size
+        skip = self.size - pos if pos + nbytes > self.size else 0
+        if self._allocated + skip + nbytes - int(self._released[0]) > self.size:
+            return None
+        self._allocated += skip
+        offset = self._allocated % self.size
+        self._allocated += nbytes
+        return offset, self._allocated
+
+    def release(self, end):
+        """Free everything allocated before end was returned."""
+        self._released[0] = end
+
+    def close(self, unlink=False):
+        del self._released
+        self.data.release()
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+
+def dump(obj, ring=None, threshold=1024):
+    """Pickle obj for sending to another process.
+
+    If ring is given, buffers of at least threshold bytes, such as the
+    data of numpy arrays, are copied into it instead of being pickled.
+    Returns None if there is no room in the ring.
+    """
+    if ring is None:
+        return (pickle.dumps(obj, protocol=5), )
+    buffers = []
+    def out_of_band(b):
+        m = b.raw()
+        if m.nbytes < threshold:
+            return True
+        buffers.append(m)
+    data = pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+    if not buffers:
+        return (data, )
+    sizes = [-(-b.nbytes // RingBuffer.ALIGN) * RingBuffer.ALIGN for b in buffers]
+    if sum(sizes) > ring.size:
+        # It will never fit.
+        return (pickle.dumps(obj, protocol=5), )
+    a = ring.alloc(sum(sizes))
+    if a is None:
+        return None
+    offset, end = a
+    spans = []
+    for b, size in zip(buffers, sizes):
+        ring.data[offset:offset+b.nbytes] = b
+        spans.append((offset, b.nbytes))
+        offset += size
+    return (data, ring.name, spans, end)
+
+
+def load(message, ring=None, copy=False):
+    """Unpickle a message made by dump(). Buffers in the ring are used in
+    place unless copy is True. Returns (obj, end), where end should be
+    released once the ring buffers are no longer needed."""
+    if len(message) == 1:
+        return pickle.loads(message[0]), None
+    data, _, spans, end = message
+    if copy:
+        buffers = [bytearray(ring.data[o:o+n]) for o, n in spans]
+    else:
+        buffers = [ring.data[o:o+n] for o, n in spans]
+    return pickle.loads(data, buffers=buffers), end
+
+
+class ChunkSizer(object):
+
+    """
+    Chooses how many items to send to a worker process at once.
+
+    Each chunk of results reports how long its worker spent on it. The
+    pool reports how long it spent sending and receiving it. From these,
+    the size is set so that either:
+
+    - each chunk takes the worker about target / 4 seconds, if a target
+      latency is given. Up to four chunks per process are in flight, so
+      results come back about target seconds after their items are sent.
+
+    - sending and receiving costs at most overhead of the time workers
+      spend on each chunk, for the most throughput.
+
+    Chunks never take more than max_time seconds of work. The size at
+    most doubles or halves after each chunk.
+    """
+
+    label = 'C'
+
+    def __init__(self, target=None, size=1, maximum=1024, overhead=0.05, max_time=0.5):
+        self.target = target
+        self.size = size
+        self.maximum = maximum
+        self.overhead = overhead
+        self.max_time = max_time
+        self.item_time = None
+        self.chunk_time = None
+
+    def update(self, items, work, cost):
+        """Record a chunk of items which took work seconds in a worker and
+        cost seconds to send and receive."""
+        item_time = max(work, 1e-6) / items
+        if self.item_time is None:
+            self.item_time, self.chunk_time = item_time, cost
+        else:
+            self.item_time += (item_time - self.item_time) / 8
+            self.chunk_time += (cost - self.chunk_time) / 8
+        if self.target is None:
+            size = self.chunk_time / (self.overhead * self.item_time)
+        else:
+            size = self.target / (4 * self.item_time)
+        size = min(size, self.max_time / self.item_time, self.maximum, 2 * self.size)
+        self.size = max(1, int(size), self.size // 2)
+
+    def __str__(self):
+        return f', {self.label}:{self.size}'
+
+
+def denumerate(work, control, tmp_queue, ring=None, got=None):
+
+    """Strips sequence numbers from work_queue items and yields the work.
+    got is called with each sequence number as its work is taken."""
 
     poller = zmq.Poller()
     poller.register(work, zmq.POLLIN)
@@ -19,63 +183,183 @@ def denumerate(work, control, tmp_queue):
     while True:
         socks = dict(poller.poll())
         if socks.get(work) == zmq.POLLIN:
-            n, item = work.recv_pyobj()
-            tmp_queue.put((n, len(item)))
+            n, message = work.recv_pyobj()
+            start = time.perf_counter()
+            item, _ = load(message, ring)
+            if got is not None:
+                got(n)
+            tmp_queue.put((n, len(item), start))
             yield from item
         if socks.get(control) == zmq.POLLIN:
             return
 
-def renumerate(iterator, result, tmp_queue):
+def renumerate(iterator, result, tmp_queue, control=None, ring=None):
 
     """Recombines results with the sequence numbers stored in tmp_queue."""
 
     try:
         while True:
             r = [next(iterator)]
-            n, l = tmp_queue.get()
+            n, l, start = tmp_queue.get()
             while len(r) < l:
                 r.append(next(iterator))
-            result.send_pyobj((n, r))
+            message = dump(r, ring)
+            while message is None:
+                # Wait for the parent to read earlier results.
+                if control.poll(1):
+                    return
+                message = dump(r, ring)
+            result.send_pyobj((n, message, time.perf_counter() - start))
     except StopIteration:
         pass
 
 
-def worker(work_port, result_port, control_port, status_port, function, args, kwargs):
+def beat(ctx, status_addr, wid, interval, stop):
+
+    """Send 'HB' status messages every interval seconds until stop is set.
+    It has its own socket because zmq sockets can't be shared by threads."""
+
+    status = ctx.socket(zmq.PUSH)
+    status.setsockopt(zmq.IMMEDIATE, 1)
+    status.setsockopt(zmq.LINGER, 0)
+    status.connect(status_addr)
+    try:
+        while not stop.wait(interval):
+            try:
+                status.send_pyobj(('HB', wid), zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+    finally:
+        status.close()
+
 
-    """Subprocess main. Runs a generator function on items from a pipe."""
+def worker(work_addr, result_addr, control_addr, status_addr, function, args, kwargs, rings=None, heartbeat=None):
+
+    """Subprocess main. Runs a generator function on items from a pipe.
+
+    Status messages tell the pool when the worker connects, which chunks
+    it takes, and why it exits: 'INT' if interrupted and 'DED' otherwise.
+    If heartbeat is given, 'HB' is also sent every heartbeat seconds, even
+    while the function is busy, so the pool can tell the worker is alive.
+    """
 
     tmp_queue = queue.Queue()
+    work_ring = result_ring = None
+    wid = (platform.node(), os.getpid())
+    reason = 'DED'
 
     ctx = zmq.Context()
     work = ctx.socket(zmq.PULL)
     work.set_hwm(10)
     result = ctx.socket(zmq.PUSH)
     status = ctx.socket(zmq.PUSH)
+    # Don't queue messages until the pool is really there. A remote worker
+    # which starts after the pool has finished gives up instead of waiting
+    # forever to connect.
+    status.setsockopt(zmq.IMMEDIATE, 1)
+    status.setsockopt(zmq.SNDTIMEO, 10000)
     control = ctx.socket(zmq.SUB)
+    stop = threading.Event()
 
     try:
-        work.connect(f'tcp://localhost:{work_port}')
-        result.connect(f'tcp://localhost:{result_port}')
-        status.connect(f"tcp://localhost:{status_port}")
-        control.connect(f"tcp://localhost:{control_port}")
+        work.connect(work_addr)
+        result.connect(result_addr)
+        status.connect(status_addr)
+        control.connect(control_addr)
         control.setsockopt(zmq.SUBSCRIBE, b"")
-        status.send_string('CON')
-
-        renumerate(function(denumerate(work, control, tmp_queue), *args, **kwargs), result, tmp_queue)
+        if rings is not None:
+            work_ring = RingBuffer(*rings[0])
+            result_ring = RingBuffer(*rings[1])
+        status.send_pyobj(('CON', wid))
+        if heartbeat is not None:
+            threading.Thread(target=beat, args=(ctx, status_addr, wid, heartbeat, stop), daemon=True).start()
+
+        got = lambda n: status.send_pyobj(('GOT', wid, n))
+        renumerate(function(denumerate(work, control, tmp_queue, work_ring, got), *args, **kwargs), result, tmp_queue, control, result_ring)
     except KeyboardInterrupt:
+        reason = 'INT'
+    except zmq.Again:
         pass
     finally:
-        status.send_string('DED')
+        stop.set()
+        for ring in (work_ring, result_ring):
+            if ring is not None:
+                try:
+                    ring.close()
+                except BufferError:
+                    # Something still holds an array in the ring.
+                    pass
+        try:
+            status.send_pyobj((reason, wid), zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+
+def context(start_method=None, function=None):
+    """A multiprocessing context for starting workers.
+
+    The default is forkserver on Linux and spawn elsewhere. The fork server
+    imports this module and the one the function comes from before it starts
+    any workers. Workers are forked from it with numpy, zmq and so on
+    already imported, instead of each importing them again. Only the
+    modules given by the first pool in a process are preloaded, because
+    there is only one fork server.
+    """
+    if start_method is None:
+        start_method = 'forkserver' if sys.platform.startswith('linux') else 'spawn'
+    mp_ctx = mp.get_context(start_method)
+    if start_method == 'forkserver':
+        modules = [__name__]
+        module = getattr(function, '__module__', None)
+        if module is not None:
+            modules.append(module)
+        mp_ctx.set_forkserver_preload(modules)
+    return mp_ctx
 
 
 class _PureGeneratorPoolMP(object):
 
-    def __init__(self, function, processes=1, *args, **kwargs):
+    label = 'S'
+
+    def __init__(self, function, processes=1, *args, ring_size=None, transport='ipc', listen=None, start_method=None, retries=3, heartbeat=5, **kwargs):
+        if transport not in ('ipc', 'tcp'):
+            raise ValueError(f'Unknown transport {transport!r}.')
+        if start_method not in (None, *mp.get_all_start_methods()):
+            raise ValueError(f'Unknown start method {start_method!r}.')
+        if listen is not None and ring_size:
+            raise ValueError('Remote workers can not use ring buffers.')
         self._processes = processes
+        self._workers = processes
+        self._start_method = start_method
+        self.startup = None
+        self._retries = retries
+        self._heartbeat = heartbeat
+        # Chunks which crashed a worker more than retries times, and how
+        # many workers were started again after crashing.
+        self.poisoned = []
+        self.respawned = 0
+        # Workers which are connected, and those which have taken work.
+        self._alive = set()
+        self._took = set()
+        self._gone = set()
+        # When each remote worker was last heard from, and those which
+        # went silent without disconnecting.
+        self._seen = {}
+        self._silent = set()
+        # Sequence numbers carry on between calls to apply, so that
+        # messages about an earlier call can't be mistaken for this one.
+        self._next = 0
+        self._listen = listen
+        self._setup = None
+        self._transport = transport
+        self._tmpdir = None
         self._function = function
         self._args = args
         self._kwargs = kwargs
         self._procs = []
+        self._ring_size = ring_size
+        self._work_ring = None
+        self._result_rings = []
 
         # Similar to how, on Linux, putting an unpickleable object on a Queue
         # causes an uncatchable exception, passing unpickleable objects to
@@ -87,100 +371,420 @@ class _PureGeneratorPoolMP(object):
         pickle.dumps(self._kwargs)
 
     def __enter__(self):
-        mp_ctx = mp.get_context('spawn')
+        self._mp_ctx = context(self._start_method, self._function)
 
         self._ctx = zmq.Context()
 
         self._work = self._ctx.socket(zmq.PUSH)
-        work_port = self._work.bind_to_random_port('tcp://*')
-
         self._result = self._ctx.socket(zmq.PULL)
-        result_port = self._result.bind_to_random_port('tcp://*')
-
         self._status = self._ctx.socket(zmq.PULL)
-        status_port = self._status.bind_to_random_port('tcp://*')
-
         self._control = self._ctx.socket(zmq.PUB)
-        control_port = self._control.bind_to_random_port('tcp://*')
+
+        work_addr, result_addr, status_addr, control_addr = self._bind(
+            self._work, self._result, self._status, self._control
+        )
+        self._addrs = (work_addr, result_addr, control_addr, status_addr)
+
+        if self._listen is not None:
+            self._listen_remote()
 
         try:
 
-            for id in range(self._processes):
-                p = mp_ctx.Process(target=worker, args=(
-                    work_port, result_port, control_port, status_port,
-                    self._function, self._args, self._kwargs
-                ))
-                self._procs.append(p)
+            if self._ring_size:
+                self._work_ring = RingBuffer(self._ring_size)
+                self._result_rings = [RingBuffer(max(self._ring_size // self._processes, 1<<20)) for _ in range(self._processes)]
 
+            for ring in self._result_rings or [None] * self._processes:
+                self._procs.append(self._process(ring))
+
+            start = time.perf_counter()
             for p in self._procs:
                 p.start()
 
             atexit.register(self.__exit__)
 
             for p in self._procs:
-                s = self._status.recv_string()
-                if s == 'DED':
+                s, wid = self._status.recv_pyobj()
+                if s != 'CON':
                     raise ChildProcessError("Worker failed to start.")
+                self._alive.add(wid)
+            self.startup = time.perf_counter() - start
 
         except (KeyboardInterrupt, ChildProcessError):
             self._control.send_string("DIE")
+            self._close_rings()
             raise
 
         return self
 
-    def apply(self, iterable):
-        try:
-            chunksize = min(64, 1+(len(iterable)//len(self._procs)))
-        except TypeError:
-            chunksize = 64
+    def _process(self, result_ring=None):
+        rings = None
+        if result_ring is not None:
+            rings = ((self._work_ring.size, self._work_ring.name), (result_ring.size, result_ring.name))
+        return self._mp_ctx.Process(target=worker, args=(
+            *self._addrs, self._function, self._args, self._kwargs, rings
+        ))
+
+    def _respawn(self, proc):
+        """Start a new worker in place of proc, which has died. It gets a
+        new result ring because results from the old one may still be
+        waiting to be read."""
+        result_ring = None
+        if self._result_rings:
+            result_ring = RingBuffer(self._result_rings[0].size)
+            self._result_rings.append(result_ring)
+        new = self._process(result_ring)
+        new.start()
+        self._procs[self._procs.index(proc)] = new
+        self.respawned += 1
+        return new
+
+    def _bind(self, *sockets):
+        """Bind the sockets and return the addresses workers should connect to.
+
+        ipc sockets are made in a private temporary directory. If ipc is
+        not available, or the directory's path is too long for a socket,
+        the sockets are bound to random tcp ports on the loopback
+        interface instead.
+        """
+        if self._transport == 'ipc' and zmq.has('ipc'):
+            self._tmpdir = tempfile.mkdtemp(prefix='teletext-')
+            try:
+                addrs = []
+                for n, s in enumerate(sockets):
+                    addrs.append(f'ipc://{os.path.join(self._tmpdir, str(n))}')
+                    s.bind(addrs[-1])
+                return addrs
+            except zmq.ZMQError:
+                for s, a in zip(sockets, addrs):
+                    try:
+                        s.unbind(a)
+                    except zmq.ZMQError:
+                        pass
+                self._remove_tmpdir()
+        return [f'tcp://127.0.0.1:{s.bind_to_random_port("tcp://127.0.0.1")}' for s in sockets]
+
+    def _listen_remote(self):
+        """Bind tcp ports for remote workers and a socket to tell them about
+        the ports and the function to run."""
+        host, _, port = str(self._listen).rpartition(':')
+        interface = f'tcp://{host or "*"}'
+        self._remote = [
+            s.bind_to_random_port(interface)
+            for s in (self._work, self._result, self._control, self._status)
+        ]
+        self._setup = self._ctx.socket(zmq.REP)
+        if port in ('', '0'):
+            self.port = self._setup.bind_to_random_port(interface)
+        else:
+            self._setup.bind(f'{interface}:{port}')
+            self.port = int(port)
+
+    def _remove_tmpdir(self):
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def apply(self, iterable, chunksize=None, ordered=True):
+        if chunksize is None:
+            chunksize = ChunkSizer()
+        if isinstance(chunksize, ChunkSizer):
+            sizer = chunksize
+            try:
+                limit = 1+(len(iterable)//max(1, self._workers))
+            except TypeError:
+                limit = sizer.maximum
+            size = lambda: min(sizer.size, limit)
+        else:
+            sizer = None
+            size = lambda: chunksize
 
         it = iter(iterable)
-        iterable = enumerate(iter(lambda: list(itertools.islice(it, chunksize)), []))
+        iterable = enumerate(iter(lambda: list(itertools.islice(it, size())), []), start=self._next)
+        # Chunks which have been sent and not returned, the time spent
+        # sending each, and the position of each one's first item.
+        chunks = {}
+        costs = {}
+        sent = {}
+        first = {}
+        items = 0
         received = {}
-        sent_count = 0
-        received_count = 0
+        sent_count = self._next
+        received_count = self._next
         done = False
+        # Work which didn't fit in the ring buffer yet.
+        pending = None
+        # Chunks to send again because the worker holding them died.
+        requeue = collections.deque()
+        # Which worker holds each chunk, the chunks each worker has taken,
+        # in order, and how many times each chunk has crashed a worker.
+        holder = {}
+        taken = collections.defaultdict(list)
+        crashes = collections.Counter()
+        # Ring buffer space used by each chunk of work, in order of sending,
+        # and which of those have been returned but not released yet.
+        in_ring = collections.deque()
+        returned = set()
+        result_rings = {r.name: r for r in self._result_rings}
 
         poller = zmq.Poller()
         poller.register(self._work, zmq.POLLOUT)
         poller.register(self._status, zmq.POLLIN)
         poller.register(self._result, zmq.POLLIN)
+        if self._setup is not None:
+            poller.register(self._setup, zmq.POLLIN)
+        # Local workers are watched directly, because one which is killed
+        # can't say so.
+        sentinels = {p.sentinel: p for p in self._procs}
+        for s in sentinels:
+            poller.register(s, zmq.POLLIN)
+        # Remote workers can't be watched, so they send heartbeats instead,
+        # and one which stops is treated as dead. Nothing was read between
+        # calls, so start counting again now.
+        for wid in self._seen:
+            self._seen[wid] = time.monotonic()
+
+        def finish(n):
+            if any(m == n for m, _ in in_ring):
+                returned.add(n)
+            while in_ring and in_ring[0][0] in returned:
+                m, end = in_ring.popleft()
+                self._work_ring.release(end)
+                # A chunk sent again is in the ring more than once.
+                if all(k != m for k, _ in in_ring):
+                    returned.discard(m)
+
+        def status(message):
+            if message[1] in self._seen:
+                self._seen[message[1]] = time.monotonic()
+            if message[0] == 'CON':
+                # A remote worker joined or a dead one was replaced, so
+                # more work can be in flight.
+                if not any(message[1] == (platform.node(), p.pid) for p in self._procs):
+                    self._seen[message[1]] = time.monotonic()
+                self._alive.add(message[1])
+                self._workers += 1
+                if (requeue or not done) and pending is None:
+                    poller.register(self._work, zmq.POLLOUT)
+            elif message[0] == 'GOT':
+                _, wid, n = message
+                self._took.add(wid)
+                if n in chunks:
+                    if wid in self._gone:
+                        # It was given up on, so don't wait for it.
+                        requeue.append(n)
+                        if pending is None:
+                            poller.register(self._work, zmq.POLLOUT)
+                    else:
+                        holder[n] = wid
+                        taken[wid].append(n)
+            elif message[0] == 'INT':
+                raise ChildProcessError('Worker was interrupted.')
+            elif message[0] == 'DED':
+                # A silent worker which exits has disconnected too.
+                self._silent.discard(message[1])
+                lost(message[1])
+
+        def lost(wid, killed=False):
+            if wid in self._gone:
+                return
+            if wid not in self._alive:
+                raise ChildProcessError('Worker failed to start.')
+            if not killed and wid not in self._took:
+                # It raised before taking any work, so the function itself
+                # is broken and every worker will do the same.
+                raise ChildProcessError('Worker exited unexpectedly.')
+            self._alive.remove(wid)
+            self._gone.add(wid)
+            self._seen.pop(wid, None)
+            self._workers -= 1
+
+            waiting = set(requeue)
+            if pending is not None:
+                waiting.add(pending[0])
+            # Workers take chunks one at a time, so the last one it took is
+            # the one it was working on. Results for earlier ones may not
+            # have been read yet. If it was killed before saying what it
+            # took, guess the oldest chunk which no live worker has.
+            held = [n for n in taken.pop(wid, ()) if holder.get(n) == wid][-1:]
+            held = held or [n for n in sorted(chunks) if holder.get(n) not in self._alive and n not in waiting][:1]
+            if held:
+                n = held[0]
+                crashes[n] += 1
+                if crashes[n] > self._retries:
+                    self.poisoned.append(chunks.pop(n))
+                    received[n] = []
+                    finish(n)
+            # Anything not held by a live worker may have been lost with it.
+            # If it wasn't, the extra results are ignored.
+            requeue.extend(n for n in sorted(chunks) if holder.get(n) not in self._alive and n not in waiting)
+            if requeue and pending is None:
+                poller.register(self._work, zmq.POLLOUT)
+
+            for proc in self._procs:
+                if wid == (platform.node(), proc.pid):
+                    poller.unregister(proc.sentinel)
+                    del sentinels[proc.sentinel]
+                    proc.join(1)
+                    if proc.is_alive():
+                        proc.kill()
+                        proc.join()
+                    proc = self._respawn(proc)
+                    sentinels[proc.sentinel] = proc
+                    poller.register(proc.sentinel, zmq.POLLIN)
+                    result_rings.update((r.name, r) for r in self._result_rings)
+                    break
 
         while True:
-            socks = dict(poller.poll())
+            socks = dict(poller.poll(self._heartbeat * 1000 if self._seen or self._silent else None))
+
+            if socks.get(self._setup) == zmq.POLLIN:
+                self._setup.recv()
+                self._setup.send(pickle.dumps((self._remote, self._function, self._args, self._kwargs, self._heartbeat)))
 
             if socks.get(self._status) == zmq.POLLIN:
-                raise ChildProcessError('Worker exited unexpectedly.')
+                status(self._status.recv_pyobj())
+
+            for s, proc in list(sentinels.items()):
+                if s in socks:
+                    # Read what it said before dying first.
+                    while self._status.poll(10):
+                        status(self._status.recv_pyobj())
+                    lost((platform.node(), proc.pid), killed=True)
+
+            now = time.monotonic()
+            for wid, seen in list(self._seen.items()):
+                if now - seen > self._heartbeat * 3:
+                    self._silent.add(wid)
+                    lost(wid, killed=True)
+            if self._silent:
+                # A silent worker may still be connected, and then it is
+                # still sent its share of the work, so send anything which
+                # nobody has taken for a while again. Work is dealt out to
+                # workers in turn, so one more copy than there are silent
+                # workers should reach a live one.
+                waiting = set(requeue)
+                if pending is not None:
+                    waiting.add(pending[0])
+                stale = [
+                    n for n in sorted(chunks)
+                    if holder.get(n) not in self._alive and n not in waiting and now - sent.get(n, now) > self._heartbeat * 3
+                ]
+                for n in stale:
+                    sent[n] = now
+                requeue.extend(n for n in stale for _ in range(len(self._silent) + 1))
+                if stale and pending is None:
+                    poller.register(self._work, zmq.POLLOUT)
 
             if socks.get(self._result) == zmq.POLLIN:
-                n, item = self._result.recv_pyobj()
-                received[n] = item
-
-                while received_count in received:
-                    yield from received[received_count]
-                    del received[received_count]
-                    received_count += 1
-                    if not done and sent_count - received_count < self._processes * 3:
+                start = time.perf_counter()
+                n, message, work = self._result.recv_pyobj()
+                if len(message) > 1:
+                    ring = result_rings[message[1]]
+                    result, end = load(message, ring, copy=True)
+                    ring.release(end)
+                else:
+                    result, _ = load(message)
+                # Otherwise it was sent again, and the other copy is back.
+                if n in chunks:
+                    del chunks[n]
+                    sent.pop(n, None)
+                    holder.pop(n, None)
+                    received[n] = result
+                    cost = costs.pop(n) + time.perf_counter() - start
+                    if sizer is not None:
+                        sizer.update(len(result), work, cost)
+                    finish(n)
+                    if pending is not None:
                         poller.register(self._work, zmq.POLLOUT)
 
-                if done and sent_count == received_count:
-                    return
-
             if socks.get(self._work) == zmq.POLLOUT:
+                while requeue and requeue[0] not in chunks:
+                    requeue.popleft()
+                if pending is not None and pending[0] not in chunks:
+                    # Another copy of it came back while it waited.
+                    pending = None
                 try:
-                    self._work.send_pyobj(next(iterable))
-                    sent_count += 1
-                    if sent_count - received_count > self._processes * 4:
+                    if pending is not None:
+                        n, item = pending
+                    elif requeue:
+                        n = requeue.popleft()
+                        item = chunks[n]
+                    else:
+                        n, item = next(iterable)
+                        self._next = n + 1
+                        chunks[n] = item
+                        first[n] = items
+                        items += len(item)
+                        sent_count += 1
+                    start = time.perf_counter()
+                    message = dump(item, self._work_ring)
+                    if message is None:
+                        # Wait for results to free some of the ring.
+                        pending = n, item
                         poller.unregister(self._work)
+                    else:
+                        pending = None
+                        if len(message) > 1:
+                            in_ring.append((n, message[-1]))
+                        self._work.send_pyobj((n, message))
+                        costs[n] = time.perf_counter() - start
+                        sent[n] = time.monotonic()
+                        # Chunks sent again don't count towards the window.
+                        if not requeue and sent_count - received_count > self._workers * 4:
+                            poller.unregister(self._work)
                 except StopIteration:
                     done = True
+                    poller.unregister(self._work)
+
+            while received:
+                n = received_count if ordered else min(received)
+                if n not in received:
+                    break
+                result = received.pop(n)
+                start = first.pop(n)
+                yield from (result if ordered else zip(itertools.count(start), result))
+                received_count += 1
+                if requeue or (not done and sent_count - received_count < self._workers * 3):
+                    poller.register(self._work, zmq.POLLOUT)
+
+            if done and sent_count == received_count:
+                return
 
     def __exit__(self, *args):
+        # A worker's subscription to the control socket may not have reached
+        # us yet if the pool is very young, so keep telling it to die until
+        # it actually does.
         self._control.send_string("DIE")
         for proc in self._procs:
-            proc.join()
+            proc.join(0.1)
+            while proc.is_alive():
+                self._control.send_string("DIE")
+                proc.join(0.1)
+        if self._listen is not None:
+            # We can't wait for remote workers, so keep telling them for a
+            # while in case some have only just subscribed.
+            for _ in range(10):
+                self._control.send_string("DIE")
+                time.sleep(0.1)
+        self._close_rings()
+        self._ctx.destroy(linger=0)
+        self._remove_tmpdir()
         atexit.unregister(self.__exit__)
 
+    def __str__(self):
+        s = f', {self.label}:{self.startup or 0:.2f}s'
+        if self.poisoned:
+            s += f', P:{len(self.poisoned)}'
+        return s
+
+    def _close_rings(self):
+        for ring in [self._work_ring] + self._result_rings:
+            if ring is not None:
+                ring.close(unlink=True)
+        self._work_ring = None
+        self._result_rings = []
+
 
 class _PureGeneratorPoolSingle(object):
 
@@ -206,10 +810,11 @@ class _PureGeneratorPoolSingle(object):
     def __enter__(self):
         return self
 
-    def apply(self, iterable):
-        for item in iterable:
+    def apply(self, iterable, chunksize=None, ordered=True):
+        for n, item in enumerate(iterable):
             self._work_queue.put(item)
-            yield next(self._proc)
+            result = next(self._proc)
+            yield result if ordered else (n, result)
 
     def __exit__(self, *args):
         try:
@@ -218,7 +823,7 @@ class _PureGeneratorPoolSingle(object):
             pass
 
 
-def PureGeneratorPool(function, processes, *args, **kwargs):
+def PureGeneratorPool(function, processes, *args, ring_size=None, transport='ipc', listen=None, start_method=None, retries=3, heartbeat=5, **kwargs):
 
     """
     Implements a parallel processing pool similar to multiprocessing.Pool. However,
@@ -247,21 +852,95 @@ def PureGeneratorPool(function, processes, *args, **kwargs):
     is a pure generator if f is a pure generator, regardless of whether or not g
     is pure.
 
-    apply() preserves the ordering of items in the input iterator.
+    apply() preserves the ordering of items in the input iterator. With
+    ordered=False it instead yields (n, result) pairs as soon as each chunk
+    of results arrives, where n is the position of the item in the input,
+    so that one slow chunk doesn't hold back the ones after it.
+
+    Items are sent to the processes in chunks. apply() takes a chunksize,
+    which is either a fixed number of items, or a ChunkSizer which adjusts
+    the number as it measures how long the work takes. By default a
+    ChunkSizer aiming for the most throughput is used.
+
+    Work and results are pickled and sent to and from the processes over
+    zmq. If ring_size is given, the data of numpy arrays and other large
+    buffers is passed through shared memory ring buffers instead: one of
+    ring_size bytes for work, and one for each process's results.
+
+    transport is 'ipc' to connect to the processes with unix domain sockets
+    in a private temporary directory, or 'tcp' to use the loopback
+    interface. tcp is used if ipc is not available.
+
+    If listen is given as '[host:]port', other machines can join the pool
+    with remote(). The pool listens for them on that interface and port,
+    or on all interfaces and a random port if they are not given. The
+    port is in the pool's port attribute once it has started. Anyone who
+    can reach the port can run code in the pool and workers, as the
+    function and work are pickled, so only listen on trusted networks.
+    Remote workers can't use ring buffers, and processes may be 0 to
+    only use remote workers.
+
+    start_method is the multiprocessing start method for the processes,
+    as chosen by context(). Once started, the pool's startup attribute
+    holds how many seconds it took for all of them to connect.
+
+    A process which dies is started again, and the chunks it held are sent
+    to the others. A chunk which is being worked on each time a process
+    dies, more than retries times, is skipped and added to the pool's
+    poisoned list, so one bad item can't stop the whole run. A process
+    interrupted by ctrl-c stops the pool with ChildProcessError, as does
+    one which raises before taking any work. Remote workers which die are
+    not replaced. They send a heartbeat every heartbeat seconds, and one
+    which is not heard from for three times that is treated as dead, so
+    that its work is sent to the others.
     """
 
-    if processes > 1:
-        return _PureGeneratorPoolMP(function, processes, *args, **kwargs)
+    if processes > 1 or listen is not None:
+        return _PureGeneratorPoolMP(function, processes, *args, ring_size=ring_size, transport=transport, listen=listen, start_method=start_method, retries=retries, heartbeat=heartbeat, **kwargs)
     else:
         return _PureGeneratorPoolSingle(function, *args, **kwargs)
 
 
-def itermap(function, iterable, processes=1, *args, **kwargs):
+def itermap(function, iterable, processes=1, *args, chunksize=None, ordered=True, ring_size=None, transport='ipc', listen=None, start_method=None, retries=3, heartbeat=5, **kwargs):
 
     """One-shot function to make a PureGeneratorPool and apply it."""
 
-    with PureGeneratorPool(function, processes, *args, **kwargs) as pool:
-        yield from pool.apply(iterable)
+    with PureGeneratorPool(function, processes, *args, ring_size=ring_size, transport=transport, listen=listen, start_method=start_method, retries=retries, heartbeat=heartbeat, **kwargs) as pool:
+        yield from pool.apply(iterable, chunksize, ordered)
+
+
+def remote(address, processes=1, once=False, start_method=None):
+
+    """
+    Join the pool listening at 'host:port' on another machine with
+    processes workers. Waits for the pool to start if it hasn't yet, and
+    when it finishes, waits for the next one unless once is True.
+    """
+
+    host, _, port = address.rpartition(':')
+    ctx = zmq.Context()
+    try:
+        while True:
+            setup = ctx.socket(zmq.REQ)
+            setup.setsockopt(zmq.LINGER, 0)
+            setup.connect(f'tcp://{host}:{port}')
+            setup.send(b'JOIN')
+            while not setup.poll(1000):
+                pass
+            ports, function, args, kwargs, heartbeat = pickle.loads(setup.recv())
+            setup.close()
+
+            addrs = [f'tcp://{host}:{p}' for p in ports]
+            mp_ctx = context(start_method, function)
+            procs = [mp_ctx.Process(target=worker, args=(*addrs, function, args, kwargs, None, heartbeat)) for _ in range(processes)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+            if once:
+                return
+    finally:
+        ctx.destroy(linger=0)
 
 
 if __name__ in ['__main__', '__mp_main__']:
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+
+from .coding import hamming8_dec
+from .file import _map_lines, _mappable, _named
+
+
+def index_name(name):
+    """The name of the page index sidecar for a t42 file."""
+    return name + '.pages.npz'
+
+
+def _decode(lines):
+    """Magazine and row of each packet in a (n, 42) array, as Mrag decodes them."""
+    low = hamming8_dec[lines[:, 0]]
+    magazine = low & 0x7
+    magazine[magazine == 0] = 8
+    row = (low | (hamming8_dec[lines[:, 1]] << 4)) >> 3
+    return magazine, row
+
+
+def build(f, block=1<<20):
+    """Index the headers in a t42 file.
+
+    Returns a dict of arrays holding the packet number, magazine, page and
+    subpage of every header, decoded the same way as Packet does, and
+    the size of the file.
+    """
+    size = os.fstat(f.fileno()).st_size
+    lines = _map_lines(f, 42) if size >= 42 else np.zeros((0, 42), dtype=np.uint8)
+    parts = []
+    for start in range(0, len(lines), block):
+        b = lines[start:start+block]
+        magazine, row = _decode(b)
+        n = np.flatnonzero(row == 0)
+        h = hamming8_dec[b[n, 2:8]]
+        values = h[:, 0::2] | (h[:, 1::2] << 4)
+        parts.append((
+            n + start,
+            magazine[n],
+            values[:, 0],
+            (values[:, 1] & 0x7f) | ((values[:, 2] & 0x3f) << 8),
+        ))
+    if parts:
+        number, magazine, page, subpage = (np.concatenate(p) for p in zip(*parts))
+    else:
+        number, magazine, page, subpage = (np.zeros((0, ), dtype=np.int64) for _ in range(4))
+    return {
+        'number': number.astype(np.int64),
+        'magazine': magazine.astype(np.uint8),
+        'page': page.astype(np.uint8),
+        'subpage': subpage.astype(np.uint16),
+        'size': np.int64(size),
+    }
+
+
+def save(name, index):
+    with open(index_name(name), 'wb') as f:
+        np.savez(f, **index)
+
+
+def load(f):
+    """Load the page index of t42 file f, if it has an up to date one."""
+    if not (_mappable(f) and _named(f)):
+        return None
+    try:
+        with np.load(index_name(f.name)) as data:
+            index = {k: data[k] for k in data.files}
+    except (OSError, ValueError):
+        return None
+    if index.get('size') != os.fstat(f.fileno()).st_size:
+        return None
+    return index
+
+
+def _member(values, collection):
+    """Which values are in collection, which may be a range or a set."""
+    if isinstance(collection, range) and collection.step == 1:
+        return (values >= collection.start) & (values < collection.stop)
+    return np.isin(values, np.fromiter(collection, dtype=np.int64))
+
+
+def select(f, index, pages=range(0x900), subpages=range(0x3f80), headers=False, start=0, step=1):
+    """Numbers of the packets needed to find pages with pipeline.paginate.
+
+    These are the packets of each wanted page: its header, and the rest
+    of the packets in its magazine up to the next header in that magazine.
+    The next header is also included, so that paginate finishes each page
+    at the same point as it would reading the whole file.
+
+    If headers is True, return all the headers instead. Only packets
+    from start onwards in steps of step are considered, as FileChunker
+    would read them.
+    """
+    sampled = ((index['number'] - start) % step == 0) & (index['number'] >= start)
+    number = index['number'][sampled]
+    if headers or len(number) == 0:
+        return number
+    magazine = index['magazine'][sampled].astype(np.int64)
+    page = index['page'][sampled].astype(np.int64) | (magazine * 0x100)
+    wanted = (_member(page, pages) | _member(page & 0x7ff, pages)) & _member(index['subpage'][sampled], subpages)
+
+    lines = _map_lines(f, 42)
+    total = len(lines)
+    result = []
+    for m in range(1, 9):
+        in_mag = magazine == m
+        starts = number[in_mag]
+        ends = np.append(starts[1:], total)
+        for run, end in zip(starts[wanted[in_mag]], ends[wanted[in_mag]]):
+            packet_mags, _ = _decode(lines[run:end:step])
+            result.append((np.flatnonzero(packet_mags == m) * step) + run)
+            if end < total:
+                result.append(np.array([end]))
+    if not result:
+        return np.zeros((0, ), dtype=np.int64)
+    return np.unique(np.concatenate(result))
@@ -0,0 +1,237 @@
+import collections
+import contextlib
+import itertools
+import os
+import pickle
+import tempfile
+
+import zmq
+
+from .mp import ChunkSizer, PureGeneratorPool
+
+
+# Protocol, as pickled tuples over a zmq ROUTER socket:
+#
+#   client                      server
+#   ('JOB', job)          ->
+#                         <-    ('QUEUED', n)       if n jobs are ahead of it
+#                         <-    ('MORE', )          send the next blocks
+#   ('DATA', [blocks])    ->
+#   ('END', )             ->                        in reply to MORE, when done
+#                         <-    ('RESULT', result)  for each block, in order
+#                         <-    ('DONE', )
+#                         <-    ('ERROR', message)  if the workers failed, or
+#                                                   the client timed out
+#
+# The server asks for the next blocks as soon as it receives some, so that
+# one batch is always on its way while the last is decoded.
+
+
+def default_address():
+    """Where the server listens unless told otherwise: a unix domain socket
+    which only the current user can reach, or a loopback tcp port where
+    those are not available."""
+    if zmq.has('ipc'):
+        path = os.environ.get('XDG_RUNTIME_DIR')
+        if not path:
+            path = os.path.join(tempfile.gettempdir(), f'teletext-{os.getuid()}')
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        return f'ipc://{os.path.join(path, "teletext.sock")}'
+    return 'tcp://127.0.0.1:7490'
+
+
+def process_jobs(items, force_cpu=False, search='brute', eps=0, shared=None):
+    """Decode blocks for the server's pool.
+
+    Each item is (job, (numbers, lines)), where job is the dict sent by the
+    client with its card config, mode and filters. The pattern tables are
+    loaded once when the worker starts, and only the config changes
+    between jobs. If lines is None they are read from job['source'].
+    """
+    from .vbi.config import Config
+    from .vbi.line import Line, LineBatch, decode
+
+    Line.configure(Config(), force_cpu, search, eps, shared)
+    for job, (numbers, lines) in items:
+        Line.config = job['config']
+        if lines is None:
+            lines = job['source'].read(numbers)
+        yield decode(LineBatch(lines, numbers), job['mode'], job['mags'], job['rows'], job['threshold'])
+
+
+class Server(object):
+
+    """
+    Decodes VBI for clients with a pool of workers which is kept running.
+
+    Jobs are decoded one at a time, in the order they arrive. A client
+    which sends nothing for timeout seconds is assumed to have gone away,
+    and its job ends there.
+    """
+
+    def __init__(self, address, processes, force_cpu=False, search='brute', eps=0, shared_tables=True, transport='ipc', timeout=30, start_method=None):
+        self.address = address
+        self._processes = processes
+        self._kwargs = dict(force_cpu=force_cpu, search=search, eps=eps)
+        self._shared_tables = shared_tables and processes > 1
+        self._transport = transport
+        self._start_method = start_method
+        self._timeout = timeout * 1000
+        self._jobs = collections.deque()
+        # Messages from the client whose job is running.
+        self._inbox = collections.deque()
+        self._stopped = False
+        self.sizer = ChunkSizer()
+        self.served = 0
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        with self._stack:
+            if self._shared_tables:
+                from .vbi.line import Line
+                from .vbi.pattern import SharedTables
+                tables = self._stack.enter_context(SharedTables(Line.pattern_files()))
+                self._kwargs['shared'] = tables.descriptor
+            self._start_pool()
+            self._stack.callback(lambda: self._pool.__exit__(None, None, None))
+            self._ctx = zmq.Context()
+            self._stack.callback(self._ctx.destroy, linger=0)
+            self._socket = self._ctx.socket(zmq.ROUTER)
+            self._socket.bind(self.address)
+            self._stack = self._stack.pop_all()
+        return self
+
+    def __exit__(self, *args):
+        self._stack.close()
+
+    def _start_pool(self):
+        self._pool = PureGeneratorPool(process_jobs, self._processes, transport=self._transport, start_method=self._start_method, **self._kwargs)
+        self._pool.__enter__()
+
+    @property
+    def startup(self):
+        """Seconds the workers took to start, or None if there are none."""
+        return getattr(self._pool, 'startup', None)
+
+    def _send(self, client, message):
+        self._socket.send_multipart([client, pickle.dumps(message)])
+
+    def _recv(self, timeout):
+        """Receive (client, message), or None after timeout ms."""
+        if not self._socket.poll(timeout):
+            return None
+        client, data = self._socket.recv_multipart()
+        return client, pickle.loads(data)
+
+    def _recv_from(self, client):
+        """Receive the next message from client. Jobs from other clients are
+        queued. Returns None if the client doesn't reply in time."""
+        if self._inbox:
+            return self._inbox.popleft()
+        while True:
+            r = self._recv(self._timeout)
+            if r is None:
+                return None
+            sender, message = r
+            if sender == client:
+                return message
+            self._queue(sender, message)
+
+    def _poll(self, client):
+        """Take any waiting messages without blocking, so that new jobs are
+        queued and told so while a job runs."""
+        while True:
+            r = self._recv(0)
+            if r is None:
+                return
+            sender, message = r
+            if sender == client:
+                self._inbox.append(message)
+            else:
+                self._queue(sender, message)
+
+    def _queue(self, client, message):
+        if message[0] == 'JOB':
+            self._jobs.append((client, message[1]))
+            self._send(client, ('QUEUED', len(self._jobs)))
+
+    def stop(self):
+        """Make serve() return once the current job is done."""
+        self._stopped = True
+
+    def serve(self):
+        """Run jobs until stop() is called."""
+        while not self._stopped:
+            if not self._jobs:
+                r = self._recv(100)
+                if r is not None:
+                    client, message = r
+                    if message[0] == 'JOB':
+                        self._jobs.append((client, message[1]))
+                continue
+            client, job = self._jobs.popleft()
+            self._run(client, job)
+            self.served += 1
+
+    def _run(self, client, job):
+        timed_out = False
+
+        def items():
+            nonlocal timed_out
+            self._send(client, ('MORE', ))
+            while True:
+                message = self._recv_from(client)
+                if message is None:
+                    timed_out = True
+                    return
+                if message[0] != 'DATA':
+                    return
+                self._send(client, ('MORE', ))
+                for block in message[1]:
+                    yield job, block
+
+        try:
+            for result in self._pool.apply(items(), self.sizer):
+                self._send(client, ('RESULT', result))
+                self._poll(client)
+        except ChildProcessError as e:
+            self._send(client, ('ERROR', str(e)))
+            self._pool.__exit__(None, None, None)
+            self._start_pool()
+        else:
+            # Otherwise the client couldn't tell its job was cut short.
+            self._send(client, ('ERROR', 'client timed out') if timed_out else ('DONE', ))
+        self._inbox.clear()
+
+
+def submit(address, job, blocks, batch=64, timeout=10):
+    """Send a job to the server at address and yield the result for each
+    (numbers, lines) block in blocks.
+
+    Raises ConnectionError if the server doesn't answer within timeout
+    seconds, and ChildProcessError if its workers fail or it stops waiting
+    for the next blocks, because the caller took too long to take the
+    results.
+    """
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.DEALER)
+    try:
+        socket.connect(address)
+        socket.send_pyobj(('JOB', job))
+        if not socket.poll(timeout * 1000):
+            raise ConnectionError(f'No reply from a server at {address}.')
+        blocks = iter(blocks)
+        while True:
+            message = socket.recv_pyobj()
+            if message[0] == 'MORE':
+                data = list(itertools.islice(blocks, batch))
+                socket.send_pyobj(('DATA', data) if data else ('END', ))
+            elif message[0] == 'RESULT':
+                yield message[1]
+            elif message[0] == 'DONE':
+                return
+            elif message[0] == 'ERROR':
+                raise ChildProcessError(message[1])
+    finally:
+        socket.close(linger=0)
+        ctx.term()
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Keep the pattern tables converted during tests out of the user's cache.
+_cache = tempfile.TemporaryDirectory()
+os.environ['TELETEXT_CACHE'] = _cache.name
@@ -0,0 +1,96 @@
+import io
+import pickle
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from teletext.archive import ArchiveFile, decode, encode, pack, unpack
+from teletext.compression import decompressing
+from teletext.file import FileChunker
+
+
+class Pipe(io.BytesIO):
+    def seek(self, *args):
+        raise io.UnsupportedOperation
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.line_size = 64
+        self.frame_lines = 4
+        frames = []
+        for seq in range(30):
+            frame = np.random.RandomState(seq).randint(0, 256, size=self.frame_lines * self.line_size, dtype=np.uint8).tobytes()
+            frames.append(frame[:-4] + struct.pack('<I', seq + 1000))
+        # Drop a frame and end with a partial line.
+        self.data = b''.join(frames[:10] + frames[11:]) + b'xyz'
+
+    def packed(self, **kwargs):
+        output = io.BytesIO()
+        writer = pack(io.BytesIO(self.data), output, self.line_size, frame_lines=self.frame_lines, block_frames=4, **kwargs)
+        return writer, output.getvalue()
+
+    def test_encode(self):
+        for sample_size in (1, 2):
+            encoded = encode(self.data, self.line_size, sample_size)
+            self.assertEqual(decode(encoded, len(self.data), self.line_size, sample_size), self.data)
+
+    def test_roundtrip(self):
+        for codec in ('zlib', 'bz2', 'xz'):
+            writer, packed = self.packed(codec=codec)
+            self.assertEqual(writer.size, len(self.data))
+            self.assertListEqual(list(writer.sequence), list(range(1000, 1010)) + list(range(1011, 1030)))
+            for f in (io.BytesIO(packed), Pipe(packed)):
+                output = io.BytesIO()
+                unpack(f, output)
+                self.assertEqual(output.getvalue(), self.data)
+
+    def test_seek(self):
+        writer, packed = self.packed()
+        f = ArchiveFile(io.BytesIO(packed))
+        self.assertTrue(f.seekable())
+        self.assertEqual(f.members, 8)
+        self.assertListEqual(list(f.sequence), list(writer.sequence))
+        self.assertEqual(f.seek(0, 2), len(self.data))
+        for pos in (5000, 17, 4 * 256 * 4, 7000):
+            f.seek(pos)
+            self.assertEqual(f.read(300), self.data[pos:pos+300])
+
+    def test_unindexed(self):
+        _, packed = self.packed()
+        f = ArchiveFile(Pipe(packed))
+        self.assertFalse(f.seekable())
+        self.assertIsNone(f.sequence)
+        self.assertEqual(f.read(), self.data)
+
+    def test_truncated(self):
+        # As left by an interrupted pack: the last block is cut short and
+        # there is no index.
+        writer, packed = self.packed()
+        complete = 4 * self.frame_lines * self.line_size * 6
+        end = writer._index[6][0] + 10
+        for f in (io.BytesIO(packed[:end]), Pipe(packed[:end])):
+            archive = ArchiveFile(f)
+            self.assertIsNone(archive.sequence)
+            self.assertEqual(archive.read(), self.data[:complete])
+
+    def test_chunker(self):
+        _, packed = self.packed()
+        expected = list(FileChunker(io.BytesIO(self.data), self.line_size, start=3, step=2, flines=4, frange=range(1, 3), block=5))
+        named = tempfile.NamedTemporaryFile()
+        self.addCleanup(named.close)
+        named.write(packed)
+        named.flush()
+        with open(named.name, 'rb') as f:
+            f = decompressing(f)
+            self.assertIsInstance(f, ArchiveFile)
+            result = FileChunker(f, self.line_size, start=3, step=2, flines=4, frange=range(1, 3), block=5, shards=True)
+            self.assertEqual(len(result), len(expected))
+            source = pickle.loads(pickle.dumps(result.source))
+            for (numbers, lines), (e_numbers, e_lines) in zip(result, expected):
+                self.assertIsNone(lines)
+                self.assertListEqual(list(numbers), list(e_numbers))
+                self.assertTrue(np.array_equal(source.read(numbers), e_lines))
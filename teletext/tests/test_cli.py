@@ -83,3 +83,15 @@ class TestCmdShowBin(TestCommandTeletext):
 
 class TestCmdBuild(TestCommandTeletext):
     cmd = teletext.cli.build
+
+
+class TestCmdServe(TestCommandTeletext):
+    cmd = teletext.cli.serve
+
+
+class TestCmdSubmit(TestCommandTeletext):
+    cmd = teletext.cli.submit
+
+
+class TestCmdWorker(TestCommandTeletext):
+    cmd = teletext.cli.worker
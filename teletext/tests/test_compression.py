@@ -0,0 +1,129 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+
+from teletext.compression import CompressedFile, build_index, decompressing, detect, index_name
+from teletext.file import FileChunker
+
+
+class TestCompressedFile(unittest.TestCase):
+
+    compressors = {
+        'gzip': gzip.compress,
+        'bz2': bz2.compress,
+        'xz': lzma.compress,
+    }
+
+    def setUp(self):
+        self.data = np.random.RandomState(0).randint(0, 4, size=4000, dtype=np.uint8).tobytes()
+        self.parts = [self.data[n:n+700] for n in range(0, len(self.data), 700)]
+
+    def compressed(self, fmt, members=True):
+        if members:
+            data = b''.join(self.compressors[fmt](p) for p in self.parts)
+        else:
+            data = self.compressors[fmt](self.data)
+        return io.BufferedReader(io.BytesIO(data))
+
+    def test_detect(self):
+        for fmt in self.compressors:
+            self.assertEqual(detect(self.compressed(fmt)), fmt)
+        self.assertIsNone(detect(io.BufferedReader(io.BytesIO(self.data))))
+        # Raw samples which happen to start like a bz2 file.
+        self.assertIsNone(detect(io.BufferedReader(io.BytesIO(b'BZh' + self.data))))
+
+    def test_format(self):
+        f = decompressing(self.compressed('gzip'), 'raw')
+        self.assertIsInstance(f, io.BufferedReader)
+        f = decompressing(self.compressed('bz2'), 'bz2')
+        self.assertEqual(f.read(), self.data)
+        raw = io.BufferedReader(io.BytesIO(b'BZh9' + self.data))
+        self.assertEqual(decompressing(raw).read(), b'BZh9' + self.data)
+
+    def test_index(self):
+        for fmt in self.compressors:
+            f = self.compressed(fmt)
+            index = build_index(f, fmt, bufsize=100)
+            self.assertEqual(len(index), len(self.parts) + 1)
+            self.assertListEqual(list(index[:, 1]), list(range(0, len(self.data), 700)) + [len(self.data)])
+            f.seek(0, os.SEEK_END)
+            self.assertEqual(index[-1, 0], f.tell())
+
+    def test_read(self):
+        for fmt in self.compressors:
+            for members in (True, False):
+                f = CompressedFile(self.compressed(fmt, members), fmt)
+                self.assertFalse(f.seekable())
+                self.assertEqual(f.read(10), self.data[:10])
+                self.assertEqual(f.read(), self.data[10:])
+                self.assertEqual(f.read(10), b'')
+
+    def test_seek(self):
+        for fmt in self.compressors:
+            f = self.compressed(fmt)
+            f = CompressedFile(f, fmt, build_index(f, fmt))
+            self.assertTrue(f.seekable())
+            self.assertEqual(f.seek(0, os.SEEK_END), len(self.data))
+            for pos in (3000, 100, 1399, 1400, 3999):
+                f.seek(pos)
+                self.assertEqual(f.read(50), self.data[pos:pos+50])
+            f.seek(-10, os.SEEK_CUR)
+            self.assertEqual(f.read(), self.data[-10:])
+
+    def test_unindexed_seek_end(self):
+        f = CompressedFile(self.compressed('gzip'), 'gzip')
+        with self.assertRaises(io.UnsupportedOperation):
+            f.seek(0, os.SEEK_END)
+
+    def test_chunker(self):
+        for fmt in self.compressors:
+            expected = list(FileChunker(io.BytesIO(self.data), 10, start=5, step=3))
+            f = self.compressed(fmt)
+            result = FileChunker(CompressedFile(f, fmt, build_index(f, fmt)), 10, start=5, step=3)
+            self.assertEqual(len(result), len(expected))
+            self.assertListEqual(list(result), expected)
+            # Without an index, lines are read from the start.
+            result = FileChunker(CompressedFile(self.compressed(fmt), fmt), 10, start=5, step=3, limit=20)
+            self.assertListEqual(list(result), expected[:20])
+
+    def test_shards(self):
+        named = tempfile.NamedTemporaryFile(suffix='.gz')
+        self.addCleanup(named.close)
+        named.write(self.compressed('gzip').read())
+        named.flush()
+        self.addCleanup(lambda: os.path.exists(index_name(named.name)) and os.unlink(index_name(named.name)))
+        with open(named.name, 'rb') as f:
+            index = build_index(f, 'gzip')
+        with open(index_name(named.name), 'wb') as f:
+            np.save(f, index)
+
+        expected = list(FileChunker(io.BytesIO(self.data), 10, step=3, flines=16, frange=range(2, 9), block=8))
+        with open(named.name, 'rb') as f:
+            f = decompressing(f)
+            self.assertEqual(f.members, len(self.parts))
+            result = FileChunker(f, 10, step=3, flines=16, frange=range(2, 9), block=8, shards=True)
+            source = pickle.loads(pickle.dumps(result.source))
+            result = list(result)
+        self.assertEqual(len(result), len(expected))
+        for (numbers, lines), (e_numbers, e_lines) in zip(result, expected):
+            self.assertIsNone(lines)
+            self.assertListEqual(list(numbers), list(e_numbers))
+            self.assertTrue(np.array_equal(source.read(numbers), e_lines))
+
+    def test_stale_index(self):
+        named = tempfile.NamedTemporaryFile(suffix='.gz')
+        self.addCleanup(named.close)
+        self.addCleanup(lambda: os.path.exists(index_name(named.name)) and os.unlink(index_name(named.name)))
+        with open(index_name(named.name), 'wb') as f:
+            np.save(f, np.array([[0, 0], [1, 10]], dtype=np.int64))
+        named.write(self.compressed('gzip').read())
+        named.flush()
+        with open(named.name, 'rb') as f:
+            self.assertFalse(decompressing(f).seekable())
@@ -1,9 +1,11 @@
 import io
+import pickle
+import tempfile
 import unittest
 
 import numpy as np
 
-from teletext.file import FileChunker
+from teletext.file import FileChunker, ReadAhead
 
 class TestChunker(unittest.TestCase):
     def setUp(self):
@@ -21,3 +23,136 @@ class TestChunker(unittest.TestCase):
         self.assertEqual(len(result), len(self.data[::2]))
         for n in range(128):
             self.assertEqual(result[n], (n*2, bytes([n*2])))
+
+    def test_unseekable_start(self):
+        class Pipe(io.BytesIO):
+            def seek(self, *args):
+                raise io.UnsupportedOperation
+        data = bytes(range(64))
+        self.assertListEqual(list(FileChunker(Pipe(data), 2, start=3, flines=4, frange=range(1, 3))), list(FileChunker(io.BytesIO(data), 2, start=3, flines=4, frange=range(1, 3))))
+
+
+class TestMappedChunker(unittest.TestCase):
+    def setUp(self):
+        self.file = tempfile.TemporaryFile()
+        self.file.write(np.arange(0, 1000, dtype=np.uint16).tobytes())
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def assertSameChunks(self, size, **kwargs):
+        expected = list(FileChunker(self.file, size, **kwargs))
+        result = FileChunker(self.file, size, memmap=True, **kwargs)
+        self.assertEqual(len(result), len(expected))
+        result = list(result)
+        self.assertListEqual([n for n, _ in result], [n for n, _ in expected])
+        for (_, r), (_, e) in zip(result, expected):
+            self.assertIsInstance(r, np.ndarray)
+            self.assertEqual(r.tobytes(), e)
+
+    def test_basic(self):
+        self.assertSameChunks(2)
+        self.assertSameChunks(6)
+
+    def test_range(self):
+        self.assertSameChunks(4, start=10, stop=200, step=3)
+        self.assertSameChunks(4, start=7, step=5, limit=20)
+
+    def test_fields(self):
+        self.assertSameChunks(2, flines=16, frange=range(2, 9))
+        self.assertSameChunks(2, start=3, step=2, flines=313, frange=range(6, 23))
+        self.assertSameChunks(2, flines=48, frange=range(40, 48))
+
+    def assertSameBlocks(self, size, block, memmap, **kwargs):
+        expected = list(FileChunker(self.file, size, **kwargs))
+        result = FileChunker(self.file, size, memmap=memmap, block=block, **kwargs)
+        self.assertEqual(result.lines, len(expected))
+        self.assertEqual(len(result), -(-len(expected) // block))
+        result = list(result)
+        self.assertEqual(len(result), -(-len(expected) // block))
+        self.assertListEqual([n for numbers, _ in result for n in numbers], [n for n, _ in expected])
+        for numbers, lines in result:
+            self.assertEqual(lines.shape, (len(numbers), size))
+        self.assertEqual(b''.join(lines.tobytes() for _, lines in result), b''.join(e for _, e in expected))
+
+    def test_blocks(self):
+        for memmap in (False, True):
+            self.assertSameBlocks(2, 16, memmap)
+            self.assertSameBlocks(4, 7, memmap, start=10, stop=200, step=3)
+            self.assertSameBlocks(2, 32, memmap, start=3, step=2, flines=313, frange=range(6, 23))
+
+    def test_mapped_block_views(self):
+        numbers, lines = next(iter(FileChunker(self.file, 2, memmap=True, block=16)))
+        self.assertFalse(lines.flags.owndata)
+        self.assertListEqual(list(numbers), list(range(16)))
+
+    def test_shards(self):
+        expected = list(FileChunker(self.file, 2, step=3, flines=16, frange=range(2, 9), block=8))
+        named = tempfile.NamedTemporaryFile()
+        self.addCleanup(named.close)
+        self.file.seek(0)
+        named.write(self.file.read())
+        named.flush()
+        result = FileChunker(named, 2, step=3, flines=16, frange=range(2, 9), memmap=True, block=8, shards=True)
+        source = pickle.loads(pickle.dumps(result.source))
+        result = list(result)
+        self.assertEqual(len(result), len(expected))
+        for (numbers, lines), (e_numbers, e_lines) in zip(result, expected):
+            self.assertIsInstance(numbers, range)
+            self.assertIsNone(lines)
+            self.assertListEqual(list(numbers), list(e_numbers))
+            self.assertTrue(np.array_equal(source.read(numbers), e_lines))
+
+    def test_shards_unnamed(self):
+        result = FileChunker(self.file, 2, memmap=True, block=8, shards=True)
+        self.assertFalse(hasattr(result, 'source'))
+        self.assertIsNotNone(next(iter(result))[1])
+
+    def test_numbers(self):
+        expected = list(FileChunker(self.file, 2, start=3, step=2, stop=500))
+        numbers = [1, 3, 4, 9, 11, 51, 499, 501, 700]
+        wanted = [(n, c) for n, c in expected if n in numbers]
+        self.assertListEqual(list(FileChunker(self.file, 2, start=3, step=2, stop=500, numbers=numbers)), wanted)
+        result = FileChunker(self.file, 2, start=3, step=2, stop=500, numbers=numbers, memmap=True)
+        self.assertEqual(len(result), len(wanted))
+        self.assertListEqual([(n, c.tobytes()) for n, c in result], wanted)
+        self.file.seek(0)
+        self.assertListEqual(list(FileChunker(io.BytesIO(self.file.read()), 2, start=3, step=2, stop=500, numbers=numbers)), wanted)
+
+    def test_not_mappable(self):
+        result = list(FileChunker(io.BytesIO(bytes(range(16))), 4, memmap=True))
+        self.assertEqual(result[1], (1, bytes(range(4, 8))))
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def test_read(self):
+        data = bytes(range(256)) * 10
+        f = ReadAhead(io.BufferedReader(io.BytesIO(data)), bufsize=100, depth=3)
+        self.assertFalse(f.seekable())
+        self.assertEqual(f.read(7), data[:7])
+        self.assertEqual(f.read(250), data[7:257])
+        self.assertEqual(f.read(), data[257:])
+        self.assertEqual(f.read(10), b'')
+        self.assertEqual(str(f), ', B:0%')
+
+    def test_chunker(self):
+        data = bytes(range(256)) * 10
+        f = ReadAhead(io.BytesIO(data), bufsize=7)
+        self.assertListEqual(list(FileChunker(f, 16, start=2, step=3)), list(FileChunker(io.BytesIO(data), 16, start=2, step=3)))
+
+    def test_error(self):
+        class Broken(io.RawIOBase):
+            def read(self, size):
+                raise OSError('broken')
+        f = ReadAhead(Broken())
+        with self.assertRaises(OSError):
+            f.read(10)
+
+    def test_close(self):
+        f = ReadAhead(io.BytesIO(bytes(1000)), bufsize=1, depth=2)
+        f.read(1)
+        f.close()
+        f._thread.join(1)
+        self.assertFalse(f._thread.is_alive())
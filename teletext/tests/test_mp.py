@@ -1,12 +1,17 @@
-from multiprocessing import current_process
+from multiprocessing import current_process, get_context
 import unittest
 from functools import wraps
 from itertools import count, islice
 import os
+import shutil
+import signal
 import sys
+import tempfile
 import time
 
-from teletext.mp import itermap, PureGeneratorPool, _PureGeneratorPoolSingle, _PureGeneratorPoolMP
+import numpy as np
+
+from teletext.mp import itermap, PureGeneratorPool, _PureGeneratorPoolSingle, _PureGeneratorPoolMP, RingBuffer, ChunkSizer, dump, load, remote
 
 from .test_sigint import ctrl_c
 
@@ -29,6 +34,11 @@ def callcount(it):
         yield callcounter
 
 
+def pid(it):
+    for x in it:
+        yield os.getpid()
+
+
 def crashy(it):
     for x in it:
         if x:
@@ -37,6 +47,56 @@ def crashy(it):
             yield x
 
 
+def killed(it):
+    # Like being killed by the OOM killer part way through an item: no
+    # exception, no goodbye.
+    for x in it:
+        if x:
+            time.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGKILL)
+        yield x
+
+
+def slow(it):
+    for x in it:
+        time.sleep(0.002)
+        yield x
+
+
+def stall(it):
+    for x in it:
+        if x == 0:
+            time.sleep(0.5)
+        yield x
+
+
+def hang(it, flag):
+    # Like a remote machine going away: the worker stops without saying
+    # anything, but only the first time.
+    for x in it:
+        if x == 100:
+            try:
+                os.rename(flag, flag + str(os.getpid()))
+            except FileNotFoundError:
+                pass
+            else:
+                os.kill(os.getpid(), signal.SIGSTOP)
+        yield x
+
+
+def killed_once(it, flag):
+    # Killed part way through the array starting with 100, but only once.
+    for x in it:
+        if x[0] == 100:
+            try:
+                os.remove(flag)
+            except FileNotFoundError:
+                pass
+            else:
+                os.kill(os.getpid(), signal.SIGKILL)
+        yield x
+
+
 def early_crash(it):
     raise ValueError('Crashed early on purpose.')
 
@@ -73,6 +133,20 @@ class TestMPSingle(unittest.TestCase):
             result = list(pool.apply(input[50:]))
             self.assertListEqual(result, expected[50:])
 
+    def test_chunksize(self):
+        input = list(range(100))
+        expected = list(multiply(input, 3))
+        for chunksize in (1, 7, 200):
+            result = list(itermap(multiply, input, self.procs, 3, chunksize=chunksize))
+            self.assertListEqual(result, expected)
+
+    def test_unordered(self):
+        input = list(range(100))
+        expected = list(enumerate(multiply(input, 3)))
+        for chunksize in (None, 1, 7):
+            result = list(itermap(multiply, input, self.procs, 3, chunksize=chunksize, ordered=False))
+            self.assertListEqual(sorted(result), expected)
+
     def test_called_once_reuse(self):
         with PureGeneratorPool(callcount, processes=self.procs) as pool:
             for n in range(self.procs + 1): # ensure at least one process is used twice
@@ -105,6 +179,41 @@ class TestMPMulti(TestMPSingle):
     procs = 2
     desired_type = _PureGeneratorPoolMP
 
+    def _crashing_iter(self, n, function=crashy):
+        # Crashed workers are replaced, and the chunk they crashed on is
+        # given up after crashing one more.
+        input = ([False]*n) + [True]
+        with PureGeneratorPool(function, self.procs, retries=1) as pool:
+            result = list(pool.apply(input))
+        self.assertEqual(len(pool.poisoned), 1)
+        self.assertIn(True, pool.poisoned[0])
+        self.assertEqual(len(result) + len(pool.poisoned[0]), len(input))
+        self.assertNotIn(True, result)
+        self.assertEqual(pool.respawned, 2)
+
+    def test_killed(self):
+        self._crashing_iter(0, killed)
+        self._crashing_iter(40, killed)
+
+    def test_requeue(self):
+        input = list(range(400))
+        with PureGeneratorPool(slow, self.procs) as pool:
+            it = pool.apply(input, chunksize=5)
+            result = [next(it)]
+            os.kill(pool._procs[0].pid, signal.SIGKILL)
+            result.extend(it)
+            self.assertListEqual(result, input)
+            self.assertEqual(pool.respawned, 1)
+            self.assertListEqual(pool.poisoned, [])
+            # The new worker is used for the next run.
+            self.assertListEqual(list(pool.apply(input)), input)
+
+    def test_unordered_stall(self):
+        # The slow first item doesn't hold back the others.
+        result = list(itermap(stall, range(20), self.procs, chunksize=1, ordered=False))
+        self.assertNotEqual(result[0], (0, 0))
+        self.assertListEqual(sorted(result), [(n, n) for n in range(20)])
+
     def test_unpickleable_function(self):
         with self.assertRaises(AttributeError):
             list(itermap(lambda x: x, ([False] * 3), self.procs))
@@ -118,6 +227,229 @@ class TestMPMulti(TestMPSingle):
             list(itermap(null, ([None]*10) + [lambda x: x], self.procs, None))
 
 
+class TestRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = RingBuffer(1024)
+        self.addCleanup(self.ring.close, True)
+
+    def test_alloc(self):
+        a = self.ring.alloc(500)
+        b = self.ring.alloc(300)
+        self.assertEqual(a, (0, 512))
+        self.assertEqual(b, (512, 832))
+        self.assertIsNone(self.ring.alloc(300))
+        self.ring.release(a[1])
+        # Doesn't fit at the end, so wraps to the start.
+        self.assertEqual(self.ring.alloc(300), (0, 1344))
+        self.assertIsNone(self.ring.alloc(200))
+        self.ring.release(b[1])
+        self.assertEqual(self.ring.alloc(200), (320, 1600))
+
+    def test_dump(self):
+        self.ring = RingBuffer(3072)
+        self.addCleanup(self.ring.close, True)
+        obj = [np.arange(1000, dtype=np.uint16), np.arange(10), b'x' * 2000]
+        message = dump(obj, self.ring)
+        self.assertEqual(len(message), 4)
+        self.assertLess(len(message[0]), 2500)
+        result, end = load(message, self.ring)
+        self.assertTrue(np.array_equal(result[0], obj[0]))
+        self.assertTrue(np.array_equal(result[1], obj[1]))
+        self.assertEqual(result[2], obj[2])
+        self.assertEqual(end, 2048)
+        self.assertIsNone(dump(obj, self.ring))
+        del result
+        self.ring.release(end)
+        self.assertIsNotNone(dump(obj, self.ring))
+
+    def test_too_big(self):
+        obj = np.zeros(5000, dtype=np.uint8)
+        message = dump(obj, self.ring)
+        self.assertEqual(len(message), 1)
+        self.assertTrue(np.array_equal(load(message)[0], obj))
+
+
+class TestMPRing(unittest.TestCase):
+
+    def test_arrays(self):
+        input = [np.full(3000, n, dtype=np.uint16) for n in range(200)]
+        expected = [a * 3 for a in input]
+        # Small enough that sending has to wait for results.
+        result = list(itermap(multiply, input, 2, 3, chunksize=4, ring_size=1<<16))
+        self.assertEqual(len(result), len(expected))
+        for r, e in zip(result, expected):
+            self.assertTrue(np.array_equal(r, e))
+            self.assertTrue(r.flags.writeable)
+
+    def test_objects(self):
+        input = list(range(100)) + [np.arange(5000)] + list(range(10))
+        result = list(itermap(null, input, 2, 'a', ring_size=1<<20))
+        self.assertListEqual([r[0] for r in result[:100]], input[:100])
+        self.assertTrue(np.array_equal(result[100][0], input[100]))
+
+    def test_reuse(self):
+        with PureGeneratorPool(multiply, 2, 2, ring_size=1<<16) as pool:
+            for n in range(3):
+                input = [np.full(1000, n)] * 50
+                result = list(pool.apply(input, chunksize=5))
+                self.assertTrue(all(np.array_equal(r, a * 2) for r, a in zip(result, input)))
+
+    def test_requeue(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        flag = os.path.join(tmpdir, 'flag')
+        open(flag, 'w').close()
+        input = [np.full(1000, n) for n in range(300)]
+        with PureGeneratorPool(killed_once, 2, flag, ring_size=1<<16) as pool:
+            result = list(pool.apply(input, chunksize=4))
+            self.assertEqual(pool.respawned, 1)
+        self.assertTrue(all(np.array_equal(r, a) for r, a in zip(result, input)))
+        self.assertEqual(len(result), len(input))
+
+
+class TestMPTransport(unittest.TestCase):
+
+    def test_transports(self):
+        input = list(range(100))
+        expected = list(multiply(input, 3))
+        for transport in ('ipc', 'tcp'):
+            with PureGeneratorPool(multiply, 2, 3, transport=transport) as pool:
+                tmpdir = pool._tmpdir
+                self.assertListEqual(list(pool.apply(input)), expected)
+            if tmpdir is not None:
+                self.assertFalse(os.path.exists(tmpdir))
+
+    def test_fallback(self):
+        # Too long for a unix domain socket path.
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        longdir = os.path.join(tmpdir, 'x' * 100, 'y' * 100)
+        os.makedirs(longdir)
+        saved, tempfile.tempdir = tempfile.tempdir, longdir
+        try:
+            with PureGeneratorPool(multiply, 2, 3) as pool:
+                self.assertIsNone(pool._tmpdir)
+                self.assertListEqual(list(pool.apply(range(10))), list(multiply(range(10), 3)))
+        finally:
+            tempfile.tempdir = saved
+        self.assertListEqual(os.listdir(longdir), [])
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            PureGeneratorPool(multiply, 2, 3, transport='udp')
+
+
+class TestMPStartMethod(unittest.TestCase):
+
+    def test_start_methods(self):
+        input = list(range(100))
+        expected = list(multiply(input, 3))
+        for method in ('forkserver', 'spawn', 'fork'):
+            with PureGeneratorPool(multiply, 2, 3, start_method=method) as pool:
+                self.assertListEqual(list(pool.apply(input)), expected)
+                self.assertGreater(pool.startup, 0)
+                self.assertIn(', S:', str(pool))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            PureGeneratorPool(multiply, 2, 3, start_method='teleport')
+
+
+class TestChunkSizer(unittest.TestCase):
+
+    def test_throughput(self):
+        sizer = ChunkSizer()
+        sizes = []
+        for _ in range(12):
+            # 1ms to send and receive, 10us per item.
+            sizer.update(sizer.size, sizer.size * 1e-5, 1e-3)
+            sizes.append(sizer.size)
+        self.assertListEqual(sizes[:4], [2, 4, 8, 16])
+        self.assertEqual(sizes[-1], 1024)
+        self.assertEqual(str(sizer), ', C:1024')
+
+    def test_target(self):
+        sizer = ChunkSizer(target=0.04, size=64)
+        for _ in range(20):
+            sizer.update(sizer.size, sizer.size * 1e-3, 1e-3)
+        self.assertEqual(sizer.size, 10)
+        # Work suddenly gets slower. The size halves at most each time.
+        sizer.update(sizer.size, sizer.size * 0.1, 1e-3)
+        self.assertEqual(sizer.size, 5)
+
+    def test_max_time(self):
+        sizer = ChunkSizer(size=64)
+        sizer.update(64, 64 * 0.02, 0.5)
+        self.assertEqual(sizer.size, 32)
+
+    def test_apply(self):
+        input = list(range(3000))
+        sizer = ChunkSizer()
+        result = list(itermap(multiply, input, 2, 3, chunksize=sizer))
+        self.assertListEqual(result, list(multiply(input, 3)))
+        self.assertGreater(sizer.size, 1)
+        self.assertIsNotNone(sizer.item_time)
+
+
+class TestMPRemote(unittest.TestCase):
+
+    def join(self, port, processes):
+        p = get_context('spawn').Process(target=remote, args=(f'127.0.0.1:{port}', processes, True))
+        p.start()
+        self.addCleanup(p.join, 5)
+        return p
+
+    def test_remote_only(self):
+        input = list(range(2000))
+        with PureGeneratorPool(multiply, 0, 3, listen='127.0.0.1:0') as pool:
+            p = self.join(pool.port, 2)
+            # apply() can finish before the second worker has connected,
+            # and then its CON is only read by the next apply().
+            for _ in range(100):
+                self.assertListEqual(list(pool.apply(input)), list(multiply(input, 3)))
+                if pool._workers == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(pool._workers, 2)
+        p.join(5)
+        self.assertEqual(p.exitcode, 0)
+
+    def test_mixed(self):
+        input = list(range(2000))
+        with PureGeneratorPool(pid, 2, listen='127.0.0.1:0') as pool:
+            local = set(pool.apply(range(100)))
+            self.join(pool.port, 1)
+            self.join(pool.port, 1)
+            # Keep sending work until both remote workers have done some.
+            for _ in range(100):
+                result = set(pool.apply(range(500), chunksize=1))
+                if pool._workers == 4 and len(result - local) == 2:
+                    break
+            self.assertEqual(len(result - local), 2)
+
+    def test_rings(self):
+        with self.assertRaises(ValueError):
+            PureGeneratorPool(multiply, 2, 3, listen='0', ring_size=1<<20)
+
+    def test_heartbeat(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        flag = os.path.join(tmpdir, 'flag')
+        open(flag, 'w').close()
+        input = list(range(200))
+        with PureGeneratorPool(hang, 0, flag, listen='127.0.0.1:0', heartbeat=0.1) as pool:
+            p = self.join(pool.port, 2)
+            try:
+                self.assertListEqual(list(pool.apply(input, chunksize=10)), input)
+                self.assertEqual(len(pool._gone), 1)
+            finally:
+                for f in os.listdir(tmpdir):
+                    os.kill(int(f[4:]), signal.SIGKILL)
+        p.join(5)
+        self.assertEqual(p.exitcode, 0)
+
+
 class TestMPMultiSigInt(unittest.TestCase):
 
     pool_size = 4
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from teletext import pageindex, pipeline
+from teletext.file import FileChunker
+from teletext.packet import Packet
+
+
+class TestPageIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        next_page = {m: 0 for m in range(1, 9)}
+        pending = {m: [] for m in range(1, 9)}
+        data = []
+        for n in range(3000):
+            m = rng.randint(1, 9)
+            if not pending[m]:
+                pending[m] = [Packet() for _ in range(6)]
+                for row, p in enumerate(pending[m]):
+                    p.mrag.magazine = m
+                    p.mrag.row = row
+                pending[m][0].header.page = next_page[m] % 0x100
+                pending[m][0].header.subpage = rng.randint(0, 3)
+                next_page[m] += rng.randint(1, 30)
+            b = pending[m].pop(0)[:].copy()
+            if rng.rand() < 0.02:
+                b[rng.randint(0, 8)] ^= 1 << rng.randint(0, 8)
+            data.append(b.tobytes())
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.write(b''.join(data))
+        self.file.flush()
+        self.index = pageindex.build(self.file)
+
+    def tearDown(self):
+        self.file.close()
+
+    def packets(self, **kwargs):
+        return [Packet(data, number) for number, data in FileChunker(self.file, 42, **kwargs)]
+
+    def paginate(self, packets, pages, subpages):
+        return [[p.number for p in pl] for pl in pipeline.paginate(packets, pages, subpages)]
+
+    def test_build(self):
+        packets = self.packets()
+        headers = [p for p in packets if p.mrag.row == 0]
+        self.assertListEqual(list(self.index['number']), [p.number for p in headers])
+        self.assertListEqual(list(self.index['magazine']), [p.mrag.magazine for p in headers])
+        self.assertListEqual(list(self.index['page']), [p.header.page for p in headers])
+        self.assertListEqual(list(self.index['subpage']), [p.header.subpage for p in headers])
+
+    def test_select(self):
+        cases = [
+            ({0x100}, range(0x3f80), {}),
+            ({0x1a0, 0x8fe, 0x305, 0x0ff}, range(0x3f80), {}),
+            (range(0x900), {2}, {}),
+            ({0x240, 0x11d}, {0, 1}, dict(start=10, step=3, limit=700)),
+        ]
+        for pages, subpages, kwargs in cases:
+            expected = self.paginate(self.packets(**kwargs), pages, subpages)
+            numbers = pageindex.select(self.file, self.index, pages, subpages, start=kwargs.get('start', 0), step=kwargs.get('step', 1))
+            result = self.paginate(self.packets(numbers=numbers, **kwargs), pages, subpages)
+            self.assertListEqual(result, expected)
+            self.assertLess(len(numbers), 3000)
+
+    def test_headers(self):
+        numbers = pageindex.select(self.file, self.index, headers=True)
+        self.assertTrue(all(p.mrag.row == 0 for p in self.packets(numbers=numbers)))
+
+    def test_load(self):
+        pageindex.save(self.file.name, self.index)
+        self.addCleanup(os.unlink, pageindex.index_name(self.file.name))
+        index = pageindex.load(self.file)
+        self.assertTrue(np.array_equal(index['number'], self.index['number']))
+        self.file.write(bytes(42))
+        self.file.flush()
+        self.assertIsNone(pageindex.load(self.file))
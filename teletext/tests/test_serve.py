@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from teletext.file import blocks
+from teletext.packet import Packet
+from teletext.serve import Server, submit
+from teletext.vbi.config import Config
+from teletext.vbi.line import Line, process_blocks
+
+from .vbi import test_line
+
+
+def flatten(results):
+    return [r.bytes if isinstance(r, Packet) else r for block in results for r in block]
+
+
+class TestServe(unittest.TestCase):
+
+    processes = 2
+
+    def setUp(self):
+        Line.configure(Config(), force_cpu=True)
+        self.lines = list(test_line.LineBatchTestCase.teletextgen(self, 40))
+        self.blocks = list(blocks(enumerate(self.lines), 2048, 8))
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.address = f'ipc://{os.path.join(tmpdir, "sock")}'
+        self.server = Server(self.address, self.processes, force_cpu=True, timeout=5).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        thread = threading.Thread(target=self.server.serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.stop)
+
+    def job(self, mode, mags=range(9), rows=range(32)):
+        return dict(config=Config(), mode=mode, mags=mags, rows=rows, threshold=0, source=None)
+
+    def expected(self, mode, mags=range(9), rows=range(32)):
+        return flatten(process_blocks(self.blocks, mode, Config(), force_cpu=True, mags=mags, rows=rows))
+
+    def test_submit(self):
+        for mode, mags in (('slice', range(9)), ('deconvolve', range(9)), ('deconvolve', [1, 2, 3])):
+            result = flatten(submit(self.address, self.job(mode, mags), self.blocks, batch=2))
+            self.assertListEqual(result, self.expected(mode, mags))
+        self.assertEqual(self.server.served, 3)
+
+    def test_queued(self):
+        results = {}
+        def run(mode):
+            results[mode] = flatten(submit(self.address, self.job(mode), self.blocks, batch=1))
+        threads = [threading.Thread(target=run, args=(mode, )) for mode in ('deconvolve', 'slice')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertListEqual(results['deconvolve'], self.expected('deconvolve'))
+        self.assertListEqual(results['slice'], self.expected('slice'))
+
+    def test_client_timeout(self):
+        self.server._timeout = 1000
+        # One line per block, so that most are still to be sent.
+        results = submit(self.address, self.job('slice'), blocks(enumerate(self.lines), 2048, 1), batch=1)
+        next(results)
+        time.sleep(1.5)
+        with self.assertRaises(ChildProcessError):
+            list(results)
+
+    def test_no_server(self):
+        with self.assertRaises(ConnectionError):
+            list(submit(self.address + 'x', self.job('slice'), self.blocks, timeout=0.1))
+
+
+class TestServeSingle(TestServe):
+
+    processes = 1
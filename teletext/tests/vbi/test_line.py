@@ -1,11 +1,19 @@
+import itertools
 import os
+import tempfile
 import unittest
+from unittest import mock
 
 import numpy as np
+from scipy.ndimage import gaussian_filter1d as gauss
 
-from teletext.file import FileChunker
-from teletext.vbi.line import Line
+from teletext.coding import hamming8_encode
+from teletext.pipeline import paginate
+from teletext.file import FileChunker, blocks
+from teletext.packet import Packet
+from teletext.vbi.line import Line, LineBatch, needs_deconvolve, process_lines, process_blocks
 from teletext.vbi.config import Config
+from teletext.vbi.pagetracker import PageTracker
 
 
 class LineTestCase(unittest.TestCase):
@@ -48,3 +56,229 @@ class LineTestCase(unittest.TestCase):
         except FileNotFoundError:
             self.skipTest('Known reject data not available.')
 
+
+class LineBatchTestCase(unittest.TestCase):
+
+    def teletextgen(self, n, packets=None):
+        """Generate crude synthetic teletext lines with random offsets and noise.
+
+        If packets is given, line i carries the bytes of packets[i].
+        """
+        config = Line.config
+        rng = np.random.default_rng(0)
+        x = np.arange(2048)
+        for i in range(n):
+            data = rng.integers(0, 256, size=(42, ), dtype=np.uint8)
+            data[:2] = [hamming8_encode(v) for v in rng.integers(0, 16, size=(2, ))]
+            if packets is not None:
+                data = packets[i]
+            bits = np.concatenate([config.crifc > 0, np.unpackbits(data[:, None], axis=1)[:, ::-1].flatten(), np.zeros(8)])
+            idx = np.floor((x - config.start_slice.start - rng.uniform(5, 60)) / config.bit_width).astype(np.int64)
+            sig = np.where((idx >= 0) & (idx < len(bits)), bits[np.clip(idx, 0, len(bits) - 1)], 0)
+            sig = gauss(sig * 160.0 + 20, 3) + rng.normal(0, 4 + (i % 4) * 3, size=(2048, ))
+            yield np.clip(sig, 0, 255).astype(np.uint8).tobytes()
+
+    def setUp(self):
+        Line.configure(Config(), force_cpu=True)
+        lines = list(self.teletextgen(30)) + [data for data, params in LineTestCase.noisegen(self, 256, 8)][::20]
+        self.chunks = list(enumerate(lines))
+
+    def assertSameResults(self, mode, **kwargs):
+        expected = [getattr(Line(chunk, number), mode)(**kwargs) for number, chunk in self.chunks]
+        result = getattr(LineBatch.from_chunks(self.chunks), mode)(**kwargs)
+        self.assertEqual(len(result), len(expected))
+        for e, r in zip(expected, result):
+            if isinstance(e, Packet):
+                self.assertIsInstance(r, Packet)
+                self.assertEqual(e.bytes, r.bytes)
+                self.assertEqual(e.number, r.number)
+                self.assertEqual(e._original, r._original)
+            else:
+                self.assertEqual(e, r)
+
+    def test_is_teletext(self):
+        expected = [Line(chunk).is_teletext for number, chunk in self.chunks]
+        self.assertListEqual(list(LineBatch.from_chunks(self.chunks).is_teletext), expected)
+
+    def test_start(self):
+        expected = [Line(chunk).start for number, chunk in self.chunks]
+        expected = [s for s in expected if s is not None]
+        self.assertListEqual(list(LineBatch.from_chunks(self.chunks).start), expected)
+
+    def test_start_roll_search(self):
+        for number, chunk in self.chunks:
+            line = Line(chunk)
+            if line.is_teletext:
+                start = line.start
+                # Redo the search one roll at a time, the slow way.
+                line._start = -np.argmax(np.gradient(np.maximum.accumulate(line._gstart)))
+                confidence = []
+                for roll in range(-10, 20):
+                    line.roll = roll
+                    confidence.append((np.sum(line.chop(15, 20) * line.config.crifc[15:20]), roll))
+                self.assertEqual(start, line._start + max(confidence)[1])
+
+    def test_chop_reduceat(self):
+        for number, chunk in self.chunks:
+            line = Line(chunk)
+            if line.is_teletext:
+                r = line.start
+                bits = line.config.bits
+                expected = np.add.reduceat(line.original, bits[0:369] - r)[:-1] / line.config.bit_lengths[0:368]
+                self.assertTrue(np.array_equal(line.chop(0, 368), expected))
+
+    def test_chop_out_of_range(self):
+        number, chunk = next((n, c) for n, c in self.chunks if Line(c).is_teletext)
+        line = Line(chunk)
+        length = len(line.original)
+        # Bits past the end of the line are zero, and bits before the start
+        # don't wrap around to the end.
+        line.roll = -line.start - length
+        self.assertFalse(np.any(line.chop(0, 368)))
+        line.roll = -line.start + length
+        self.assertFalse(np.any(line.chop(0, 368)))
+        batch = LineBatch.from_chunks([(number, chunk)])
+        batch._start = batch.start + length
+        self.assertFalse(np.any(batch.chop(0, 368)))
+
+    def test_chop(self):
+        lines = (Line(chunk) for number, chunk in self.chunks)
+        expected = np.stack([line.chop(0, 368) for line in lines if line.is_teletext])
+        self.assertTrue(np.array_equal(LineBatch.from_chunks(self.chunks).chop(0, 368), expected))
+
+    def test_deconvolve(self):
+        self.assertSameResults('deconvolve')
+
+    def test_deconvolve_filtered(self):
+        self.assertSameResults('deconvolve', mags=[1, 2, 3], rows=range(10))
+
+    def test_slice(self):
+        self.assertSameResults('slice')
+
+    def test_hybrid(self):
+        self.assertSameResults('hybrid')
+        self.assertSameResults('hybrid', threshold=40)
+
+    def test_hybrid_filtered(self):
+        self.assertSameResults('hybrid', mags=[1, 2, 3], rows=range(10))
+
+    def test_hybrid_skips_unwanted(self):
+        mags, rows = [1, 2, 3], range(10)
+        batch = LineBatch.from_chunks(self.chunks)
+        packets = batch._slice()
+        with mock.patch.object(LineBatch, '_deconvolve', autospec=True, side_effect=LineBatch._deconvolve) as deconvolve:
+            batch.hybrid(mags, rows)
+        redo = deconvolve.call_args.args[1]
+        self.assertLess(len(redo), sum(needs_deconvolve(p) for p in packets))
+        for n in redo:
+            m = packets[n].mrag
+            self.assertTrue(np.any(packets[n].errors[:2]) or (m.magazine in mags and m.row in rows))
+
+    def test_hybrid_modes(self):
+        lines = [Line(chunk, number) for number, chunk in self.chunks]
+        deconvolved = 0
+        for line in lines:
+            sliced = line.slice()
+            if sliced == 'rejected':
+                self.assertEqual(line.hybrid(), 'rejected')
+            elif needs_deconvolve(sliced):
+                deconvolved += 1
+                self.assertEqual(line.hybrid().bytes, line.deconvolve().bytes)
+            else:
+                self.assertEqual(line.hybrid().bytes, sliced.bytes)
+        self.assertGreater(deconvolved, 0)
+
+    def test_process_blocks_source(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b''.join(chunk for _, chunk in self.chunks))
+            f.flush()
+            shards = FileChunker(f, 2048, memmap=True, block=8, shards=True)
+            expected = list(process_blocks(blocks(self.chunks, 2048, 8), 'deconvolve', Line.config, True))
+            result = list(process_blocks(shards, 'deconvolve', Line.config, True, source=shards.source))
+        self.assertEqual(len(result), len(expected))
+        for e, r in zip(itertools.chain.from_iterable(expected), itertools.chain.from_iterable(result)):
+            if isinstance(e, Packet):
+                self.assertEqual(e.bytes, r.bytes)
+                self.assertEqual(e.number, r.number)
+            else:
+                self.assertEqual(e, r)
+
+    def test_slice_filtered(self):
+        self.assertSameResults('slice', mags=[1, 2, 3], rows=range(10))
+
+
+class PageTrackerLineTestCase(unittest.TestCase):
+
+    def pagegen(self):
+        """Packets for pages 100 to 103 in magazine 1 interleaved with page 200 in magazine 2."""
+        packets = []
+        for page in range(4):
+            for row in range(6):
+                for magazine, p in ((1, page), (2, 0)):
+                    packet = Packet()
+                    packet.mrag.magazine = magazine
+                    packet.mrag.row = row
+                    if row == 0:
+                        packet.header.page = p
+                        packet.header.subpage = 0
+                        packet.header.control = 0
+                    else:
+                        packet.displayable.place_string(f'P{magazine}{p:02x} row {row}'.ljust(40))
+                    packets.append(packet[:])
+        return packets
+
+    def setUp(self):
+        Line.configure(Config(), force_cpu=True)
+        packets = self.pagegen()
+        self.chunks = list(enumerate(LineBatchTestCase.teletextgen(self, len(packets), packets)))
+
+    def expected(self, results, pages):
+        # Decoding everything and then following the packets must give the same result.
+        tracker = PageTracker(pages)
+        for number, r in enumerate(results):
+            tracker.follow(number)
+            yield r if isinstance(r, Packet) and tracker.update(r) else 'filtered'
+
+    def assertPages(self, mode, pages, **kwargs):
+        full = list(process_lines(self.chunks, mode, Line.config, True, **kwargs))
+        expected = list(self.expected(full, pages))
+        lines = list(process_lines(self.chunks, mode, Line.config, True, pages=PageTracker(pages), **kwargs))
+        batches = process_blocks(blocks(self.chunks, 2048, 8), mode, Line.config, True, pages=PageTracker(pages), **kwargs)
+        for result in (lines, [r for b in batches for r in b]):
+            self.assertEqual(len(result), len(expected))
+            for e, r in zip(expected, result):
+                if isinstance(e, Packet):
+                    self.assertEqual(e.bytes, r.bytes)
+                else:
+                    self.assertEqual(e, r)
+        return expected
+
+    def test_deconvolve_pages(self):
+        expected = self.assertPages('deconvolve', {0x101, 0x200})
+        # Page 101 and four of page 200, and the headers of 100, 102 and 103.
+        self.assertEqual(sum(isinstance(e, Packet) for e in expected), 33)
+
+    def test_slice_pages(self):
+        self.assertPages('slice', {0x101})
+
+    def test_hybrid_pages(self):
+        self.assertPages('hybrid', {0x102, 0x200})
+
+    def test_skips_matching(self):
+        with mock.patch.object(Line, 'match_plans', side_effect=Line.match_plans) as match_plans:
+            list(process_lines(self.chunks, 'deconvolve', Line.config, True, pages=PageTracker({0x101})))
+        # All the headers, and rows 1-5 of page 101 only.
+        self.assertEqual(sum(len(c.args[0]) for c in match_plans.call_args_list), 8 + 5)
+
+    def test_filter_matches_paginate(self):
+        pages = {0x101, 0x200}
+        full = [p for p in process_lines(self.chunks, 'deconvolve', Line.config, True) if isinstance(p, Packet)]
+        expected = [p.bytes for pl in paginate(full, pages=pages) for p in pl]
+        # Split the lines as if two workers decoded them, so that the second
+        # one starts without knowing the current pages.
+        result = []
+        for chunks in (self.chunks[:21], self.chunks[21:]):
+            result.extend(p for p in process_lines(chunks, 'deconvolve', Line.config, True, pages=PageTracker(pages)) if isinstance(p, Packet))
+        self.assertGreater(len(result), len(expected))
+        result = [p.bytes for p in PageTracker(pages).filter(result)]
+        self.assertListEqual(sorted(result), sorted(expected))
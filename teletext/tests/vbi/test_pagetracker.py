@@ -0,0 +1,69 @@
+import unittest
+
+from teletext.packet import Packet
+from teletext.vbi.pagetracker import PageTracker
+
+
+def packet(magazine, row, page=None, subpage=0):
+    p = Packet()
+    p.mrag.magazine = magazine
+    p.mrag.row = row
+    if page is not None:
+        p.header.page = page
+        p.header.subpage = subpage
+        p.header.control = 0
+    return p
+
+
+class PageTrackerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = PageTracker({0x100, 0x888})
+
+    def test_unknown(self):
+        self.assertTrue(self.tracker.row(packet(1, 5).mrag))
+
+    def test_follows_headers(self):
+        self.assertTrue(self.tracker.update(packet(1, 0, 0x00)))
+        self.assertTrue(self.tracker.update(packet(1, 5)))
+        # Headers are always kept.
+        self.assertTrue(self.tracker.update(packet(1, 0, 0x01)))
+        self.assertFalse(self.tracker.update(packet(1, 5)))
+        self.assertFalse(self.tracker.row(packet(1, 29).mrag))
+        self.assertTrue(self.tracker.row(packet(2, 5).mrag))
+
+    def test_magazine_8(self):
+        self.tracker.update(packet(8, 0, 0x88))
+        self.assertTrue(self.tracker.row(packet(8, 5).mrag))
+
+    def test_subpages(self):
+        tracker = PageTracker(range(0x900), {0x1})
+        tracker.update(packet(1, 0, 0x00, 0x2))
+        self.assertFalse(tracker.row(packet(1, 5).mrag))
+        tracker.update(packet(1, 0, 0x00, 0x1))
+        self.assertTrue(tracker.row(packet(1, 5).mrag))
+
+    def test_header_errors(self):
+        self.tracker.update(packet(1, 0, 0x01))
+        p = packet(1, 0, 0x01)
+        p[2] = 0
+        self.tracker.update(p)
+        self.assertTrue(self.tracker.row(packet(1, 5).mrag))
+
+    def test_gap(self):
+        self.tracker.follow(10)
+        self.tracker.update(packet(1, 0, 0x01))
+        self.tracker.follow(11)
+        self.assertFalse(self.tracker.row(packet(1, 5).mrag))
+        self.tracker.follow(13)
+        self.assertTrue(self.tracker.row(packet(1, 5).mrag))
+
+    def test_filter(self):
+        packets = [
+            packet(1, 5), packet(1, 0, 0x00), packet(2, 0, 0x00), packet(1, 1),
+            packet(2, 1), packet(1, 0, 0x01), packet(1, 2), packet(1, 29),
+        ]
+        result = list(self.tracker.filter(packets))
+        self.assertListEqual(result, packets[1:2] + packets[3:4])
+        result = list(self.tracker.filter(packets, rows=[1]))
+        self.assertListEqual(result, packets[3:4])
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from teletext.vbi.pattern import Pattern, SharedTables, load_tables
+
+
+class PatternTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pattern = Pattern(os.path.dirname(__file__) + '/../../vbi/data/parity.dat')
+        self.inp = np.random.default_rng(0).uniform(0, 255, size=(368, )).astype(np.float32)
+
+    def brute_force(self, inp):
+        l = (len(inp)//8)-2
+        idx = np.empty((l,), dtype=np.uint32)
+        for i in range(l):
+            diffs = self.pattern.pslice - inp[(i*8) + self.pattern.start:(i*8) + self.pattern.end]
+            idx[i] = np.argmin(np.sum(diffs * diffs, axis=1))
+        return self.pattern.bytes[idx][:,0]
+
+    def test_match_equal_to_brute_force(self):
+        self.assertTrue(all(self.pattern.match(self.inp) == self.brute_force(self.inp)))
+
+    def test_match_many(self):
+        inps = [self.inp[32:368], self.inp[16:56], self.inp[96:368]]
+        results = self.pattern.match_many(inps)
+        self.assertEqual(len(results), len(inps))
+        for inp, r in zip(inps, results):
+            self.assertTrue(all(r == self.pattern.match(inp)))
+
+    def test_match_windows_blocks(self):
+        windows = self.pattern.windows(self.inp)
+        a = self.pattern.match_windows(windows)
+        b = self.pattern.match_windows(windows, block=self.pattern.n * 3)
+        self.assertTrue(all(a == b))
+
+
+class PatternKDTreeTestCase(PatternTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.brute = self.pattern
+        self.pattern = Pattern(os.path.dirname(__file__) + '/../../vbi/data/parity.dat', search='kdtree')
+
+    def test_equal_to_brute_search(self):
+        self.assertTrue(all(self.pattern.match(self.inp) == self.brute.match(self.inp)))
+        self.assertEqual(self.pattern.checked, 0)
+
+    def test_approximate_checks(self):
+        pattern = Pattern(os.path.dirname(__file__) + '/../../vbi/data/parity.dat', search='kdtree', eps=1)
+        pattern.check_interval = 1
+        result = pattern.match(self.inp)
+        self.assertEqual(pattern.checked, len(result))
+        self.assertEqual(pattern.disagreed, sum(result != self.brute.match(self.inp)))
+
+
+class PatternSearchTestCase(unittest.TestCase):
+
+    def test_unknown_search(self):
+        with self.assertRaises(ValueError):
+            Pattern(os.path.dirname(__file__) + '/../../vbi/data/parity.dat', search='magic')
+
+
+class PatternCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'parity.dat')
+        self.cache = os.path.join(self.tmpdir.name, 'cache')
+        shutil.copy(os.path.dirname(__file__) + '/../../vbi/data/parity.dat', self.filename)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_cache(self):
+        uncached = Pattern(self.filename, cache=False)
+        self.assertListEqual(os.listdir(self.tmpdir.name), ['parity.dat'])
+        first = Pattern(self.filename, cache=self.cache)
+        self.assertEqual(len(os.listdir(self.cache)), 5)
+        second = Pattern(self.filename, cache=self.cache)
+        self.assertIsInstance(second.pslice64, np.memmap)
+        for p in (first, second):
+            for a in ('patterns', 'bytes', 'pslice', 'pslice64', 'pnorms'):
+                self.assertTrue(np.array_equal(getattr(p, a), getattr(uncached, a)))
+        inp = np.random.default_rng(0).uniform(0, 255, size=(368, ))
+        self.assertTrue(all(second.match(inp) == uncached.match(inp)))
+
+    def test_stamp(self):
+        load_tables(self.filename, cache=self.cache)
+        with mock.patch('teletext.vbi.pattern.hashlib.sha1', wraps=hashlib.sha1) as sha1:
+            load_tables(self.filename, cache=self.cache)
+            # Only the path is hashed while the stamp matches.
+            self.assertEqual(sha1.call_count, 1)
+            os.utime(self.filename, ns=(0, 0))
+            arrays = load_tables(self.filename, cache=self.cache)
+            self.assertEqual(sha1.call_count, 3)
+        self.assertIsInstance(arrays['pslice64'], np.memmap)
+        self.assertEqual(len(os.listdir(self.cache)), 5)
+
+    def test_changed(self):
+        load_tables(self.filename, cache=self.cache)
+        with open(self.filename, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\xff')
+        os.utime(self.filename, ns=(0, 0))
+        arrays = load_tables(self.filename, cache=self.cache)
+        self.assertEqual(arrays['bytes'][-1, -1], 0xff)
+        self.assertEqual(len(os.listdir(self.cache)), 9)
+
+    def test_write_failure(self):
+        with mock.patch('teletext.vbi.pattern.os.replace', side_effect=OSError):
+            arrays = load_tables(self.filename, cache=self.cache)
+        self.assertListEqual(os.listdir(self.cache), [])
+        self.assertNotIsInstance(arrays['pslice64'], np.memmap)
+
+
+class SharedTablesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.filenames = [os.path.dirname(__file__) + f'/../../vbi/data/{n}.dat' for n in ('hamming', 'parity')]
+
+    def test_attach(self):
+        with SharedTables(self.filenames) as shared:
+            tables = SharedTables.attach(shared.descriptor)
+            self.assertEqual(len(tables), 2)
+            for filename in self.filenames:
+                a = Pattern(filename, cache=False)
+                b = Pattern(filename, tables=tables)
+                for name in ('patterns', 'bytes', 'pslice', 'pslice64', 'pnorms'):
+                    self.assertTrue(np.array_equal(getattr(a, name), getattr(b, name)))
+                self.assertFalse(b.pslice64.flags.writeable)
+
+    def test_unlink(self):
+        with SharedTables(self.filenames[1:]) as shared:
+            name = shared.descriptor[0]
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
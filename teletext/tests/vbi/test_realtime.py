@@ -0,0 +1,39 @@
+import unittest
+from unittest import mock
+
+from teletext.vbi.realtime import Scheduler
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('teletext.vbi.realtime.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = Scheduler('deconvolve', rate=10, max_lag=1.0)
+
+    def test_keeps_up(self):
+        result = []
+        for mode, item in self.scheduler.schedule(range(5)):
+            result.append((mode, item))
+            self.now += 0.1
+        self.assertListEqual(result, [('deconvolve', n) for n in range(5)])
+        self.assertEqual(self.scheduler.downgraded, 0)
+
+    def test_downgrade(self):
+        schedule = self.scheduler.schedule(range(3))
+        self.assertEqual(next(schedule), ('deconvolve', 0))
+        self.now += 1.6
+        self.assertEqual(next(schedule), ('slice', 1))
+        # Far behind, lines are still sliced rather than dropped.
+        self.now += 5
+        self.assertListEqual(list(schedule), [('slice', 2)])
+        self.assertDictEqual(self.scheduler.counts, {'deconvolve': 1, 'slice': 2})
+        self.assertEqual(self.scheduler.downgraded, 2)
+
+    def test_lines_per_item(self):
+        scheduler = Scheduler('hybrid', rate=10, max_lag=1.0, lines_per_item=8)
+        list(scheduler.schedule(range(4)))
+        self.assertDictEqual(scheduler.counts, {'hybrid': 32, 'slice': 0})
+        self.assertEqual(str(scheduler), ', RT:0%')
@@ -81,5 +81,14 @@ class Config(object):
         # number of samples in each bit
         self.bit_lengths = (self.bits[1:] - self.bits[:-1])
 
+        # (first sample, end sample) of each bit. Chopping a line is then a
+        # single gather from its cumulative sum: cumsum[end] - cumsum[first]
+        self.bit_bounds = np.stack((self.bits[:-1], self.bits[1:]))
+
+        # rolls to try when locking on to the clock run-in and framing code
+        self.rolls = np.arange(-10, 20)
+        # first sample of CRI/FC bits 15:20 (plus the end of bit 20) at each roll
+        self.roll_bits = self.bits[None, 15:21] - self.rolls[:, None]
+
         # fft
         self.fftbins = [0, 47, 54, 97, 104, 147, 154, 197, 204]
@@ -17,7 +17,7 @@ from teletext.packet import Packet
 from teletext.elements import Mrag, DesignationCode
 
 from .config import Config
-from .pattern import Pattern
+from .pattern import Pattern, SharedTables
 
 
 def normalise(a, start=None, end=None):
@@ -29,6 +29,84 @@ def normalise(a, start=None, end=None):
     return np.clip((a.astype(np.float32) - mn) * (255.0/r), 0, 255)
 
 
+def normalise_rows(a):
+    """Normalise each row of a 2D array independently, as normalise() does."""
+    mn = a.min(axis=1, keepdims=True)
+    mx = a.max(axis=1, keepdims=True)
+    r = (mx-mn)
+    r[r == 0] = 1
+    # Match the precision normalise() gets from scalar type promotion.
+    dtype = np.result_type(np.empty(0, dtype=np.float32), a.dtype.type(0))
+    return np.clip((a.astype(np.float32) - mn.astype(dtype)) * (255.0/r).astype(dtype), 0, 255)
+
+
+def match_plan(m, d):
+    """Decide how to match the rest of a packet once mrag and dc are known.
+
+    Returns a tuple of (destination bytes, pattern table, source bits).
+    """
+    if m.row == 0:
+        return (
+            (slice(3, 10), 'h', slice(40, 112)),
+            (slice(10, None), 'p', slice(96, 368)),
+        )
+    elif m.row < 26:
+        return ((slice(2, None), 'p', slice(32, 368)), )
+    elif m.row == 27:
+        if d.dc < 4:
+            return (
+                (slice(3, 40), 'h', slice(40, 352)),
+                (slice(40, None), 'f', slice(336, 368)),
+            )
+        else:
+            return ((slice(3, None), 'f', slice(40, 368)), ) # TODO: proper codings
+    elif m.row < 30:
+        return ((slice(3, None), 'f', slice(40, 368)), ) # TODO: proper codings
+    elif m.row == 30 and m.magazine == 8: # BDSP
+        return (
+            (slice(3, 9), 'h', slice(40, 104)), # initial page
+            # 8-bit data
+            (slice(9, 22), 'h' if d.dc in [2, 3] else 'f', slice(88, 208)),
+            (slice(22, None), 'p', slice(192, 368)), # status display
+        )
+    else:
+        return ((slice(3, None), 'f', slice(40, 368)), ) # TODO: proper codings
+
+
+def needs_deconvolve(packet, threshold=0):
+    """Decide whether a sliced packet has too many errors to be trusted.
+
+    Any Hamming error in the MRAG, or more than threshold bytes with
+    errors in the rest of the packet, means it should be deconvolved.
+    """
+    errors = packet.errors
+    return np.any(errors[:2]) or np.count_nonzero(errors[2:]) > threshold
+
+
+def wanted(m, mags, rows, pages=None):
+    """Decide whether the rest of a packet should be matched once its mrag is known.
+
+    If pages is a PageTracker, rows of pages that it does not want are
+    not. It can only follow the pages if rows includes 0.
+    """
+    return m.magazine in mags and m.row in rows and (pages is None or pages.row(m))
+
+
+def unwanted(packet, mags, rows):
+    """Decide whether a sliced packet can't be kept however it is decoded.
+
+    Only a packet whose mrag was sliced without errors can be judged, as
+    deconvolving it would find the same mrag.
+    """
+    return not np.any(packet.errors[:2]) and not wanted(packet.mrag, mags, rows)
+
+
+def keep(packet, mags, rows, pages=None):
+    """Decide whether to output a decoded packet, following it if pages is given."""
+    m = packet.mrag
+    return m.magazine in mags and (pages is None or pages.update(packet)) and m.row in rows
+
+
 # Line: Handles a single line of raw VBI samples.
 
 class Line(object):
@@ -39,13 +117,21 @@ class Line(object):
     configured = False
     cuda_ready = False
 
+    @staticmethod
+    def pattern_files():
+        """The pattern files used for hamming, parity and full matching."""
+        return (
+            os.path.dirname(__file__) + '/data/hamming.dat',
+            os.path.dirname(__file__) + '/data/parity.dat',
+            os.path.dirname(__file__) + '/data/full.dat',
+        )
+
     @classmethod
-    def configure(cls, config, force_cpu=False):
-        h = os.path.dirname(__file__) + '/data/hamming.dat'
-        p = os.path.dirname(__file__) + '/data/parity.dat'
-        f = os.path.dirname(__file__) + '/data/full.dat'
+    def configure(cls, config, force_cpu=False, search='brute', eps=0, shared=None):
+        h, p, f = cls.pattern_files()
         cls.config = config
-        if not force_cpu:
+        # Indexed searches are only implemented on the CPU.
+        if not force_cpu and search == 'brute':
             try:
                 from .patterncuda import PatternCUDA
                 cls.h = PatternCUDA(h)
@@ -56,11 +142,23 @@ class Line(object):
                 sys.stderr.write(str(e) + '\n')
                 sys.stderr.write('CUDA init failed. Using slow CPU method instead.\n')
         if not cls.cuda_ready:
-            cls.h = Pattern(h)
-            cls.p = Pattern(p)
-            cls.f = Pattern(f)
+            tables = None if shared is None else SharedTables.attach(shared)
+            cls.h = Pattern(h, search, eps, tables=tables)
+            cls.p = Pattern(p, search, eps, tables=tables)
+            cls.f = Pattern(f, search, eps, tables=tables)
         cls.configured = True
 
+    @classmethod
+    def report_disagreement(cls):
+        """Print how often approximate pattern searches differed from brute force."""
+        for name in 'hpf':
+            pattern = getattr(cls, name)
+            if pattern.checked:
+                sys.stderr.write(
+                    f'Pattern table {name}: approximate search disagreed with brute force on '
+                    f'{pattern.disagreed} of {pattern.checked} checked matches ({100*pattern.disagreement:.2f}%).\n'
+                )
+
     def __init__(self, data, number=None):
         if not Line.configured:
             Line.configure(Config())
@@ -69,6 +167,7 @@ class Line(object):
         self._original = np.frombuffer(data, dtype=Line.config.dtype).astype(np.float32)
         self._original /= 256 ** (np.dtype(Line.config.dtype).itemsize-1)
         self._original_bytes = data
+        self._cumsum = None
 
         self.reset()
 
@@ -89,12 +188,26 @@ class Line(object):
         """The raw, untouched line."""
         return self._original[:]
 
+    @property
+    def cumsum(self):
+        """Cumulative sum of the original line, with a leading zero."""
+        if self._cumsum is None:
+            # Samples are whole multiples of 1/256 so these sums are exact.
+            self._cumsum = np.concatenate(([0], np.cumsum(self._original, dtype=np.float64)))
+        return self._cumsum
+
     def chop(self, start, stop):
         """Chop and average the samples associated with each bit."""
         # This should use self.start not self._start so that self._start
         # is calculated if it hasn't been already.
         r = self.start + self.roll
-        return np.add.reduceat(self._original, Line.config.bits[start:stop+1] - r)[:-1] / Line.config.bit_lengths[start:stop]
+        first, end = self._gather(Line.config.bit_bounds[:, start:stop] - r)
+        return (end - first) / Line.config.bit_lengths[start:stop]
+
+    def _gather(self, idx):
+        """Gather idx from the cumulative sum. Samples beyond either end of
+        the line count as zero, rather than wrapping around."""
+        return self.cumsum[np.clip(idx, 0, len(self._original))]
 
     @property
     def chopped(self):
@@ -153,17 +266,16 @@ class Line(object):
             # This gives a rough location of the start.
             self._start = -np.argmax(np.gradient(np.maximum.accumulate(self._gstart)))
             # Now find the extra roll needed to lock in the clock run-in and framing code.
-            confidence = []
-            for roll in range(-10, 20):
-                self.roll = roll
-                # 15:20 is the last bit of CRI and first 4 bits of FC - 01110.
-                # This is the most distinctive part of the CRI/FC to look for.
-                confidence.append((np.sum(self.chop(15, 20) * self.config.crifc[15:20]), roll))
-            self._start += max(confidence)[1]
-            self.roll = 0
+            # 15:20 is the last bit of CRI and first 4 bits of FC - 01110.
+            # This is the most distinctive part of the CRI/FC to look for.
+            # Chop it at every roll with one gather.
+            chops = np.diff(self._gather(self.config.roll_bits - self._start), axis=1) / self.config.bit_lengths[15:20]
+            confidence = np.sum(chops * self.config.crifc[15:20], axis=1)
+            # Ties go to the highest roll.
+            self._start += self.config.rolls[::-1][np.argmax(confidence[::-1])]
         return self._start
 
-    def deconvolve(self, mags=range(9), rows=range(32)):
+    def deconvolve(self, mags=range(9), rows=range(32), pages=None):
         """Recover original teletext packet by pattern recognition."""
         if not self.is_teletext:
             return 'rejected'
@@ -180,34 +292,31 @@ class Line(object):
         bytes_array[:3] = Line.h.match(bits_array[16:56])
         m = Mrag(bytes_array[:2])
         d = DesignationCode((1, ), bytes_array[2:3])
-        if m.magazine in mags and m.row in rows:
-            if m.row == 0:
-                bytes_array[3:10] = Line.h.match(bits_array[40:112])
-                bytes_array[10:] = Line.p.match(bits_array[96:368])
-            elif m.row < 26:
-                bytes_array[2:] = Line.p.match(bits_array[32:368])
-            elif m.row == 27:
-                if d.dc < 4:
-                    bytes_array[3:40] = Line.h.match(bits_array[40:352])
-                    bytes_array[40:] = Line.f.match(bits_array[336:368])
-                else:
-                    bytes_array[3:] = Line.f.match(bits_array[40:368]) # TODO: proper codings
-            elif m.row < 30:
-                bytes_array[3:] = Line.f.match(bits_array[40:368]) # TODO: proper codings
-            elif m.row == 30 and m.magazine == 8: # BDSP
-                bytes_array[3:9] = Line.h.match(bits_array[40:104]) # initial page
-                if d.dc in [2, 3]:
-                    bytes_array[9:22] = Line.h.match(bits_array[88:208]) # 8-bit data
-                else:
-                    bytes_array[9:22] = Line.f.match(bits_array[88:208])  # 8-bit data
-                bytes_array[22:] = Line.p.match(bits_array[192:368]) # status display
-            else:
-                bytes_array[3:] = Line.f.match(bits_array[40:368]) # TODO: proper codings
-            return Packet(bytes_array, number=self._number, original=self._original_bytes)
-        else:
-            return 'filtered'
+        if wanted(m, mags, rows, pages):
+            Line.match_plans([(bytes_array, bits_array, match_plan(m, d))])
+            packet = Packet(bytes_array, number=self._number, original=self._original_bytes)
+            if keep(packet, mags, rows, pages):
+                return packet
+        return 'filtered'
 
-    def slice(self, mags=range(9), rows=range(32)):
+    @classmethod
+    def match_plans(cls, jobs):
+        """Run the pattern matches for a list of (bytes_array, bits_array, plan).
+
+        All matches which use the same pattern table are done in one call.
+        """
+        for table in 'hpf':
+            todo = [
+                (bytes_array, dst, bits_array[src])
+                for bytes_array, bits_array, plan in jobs
+                for dst, t, src in plan if t == table
+            ]
+            if todo:
+                results = getattr(cls, table).match_many([inp for _, _, inp in todo])
+                for (bytes_array, dst, _), r in zip(todo, results):
+                    bytes_array[dst] = r
+
+    def slice(self, mags=range(9), rows=range(32), pages=None):
         """Recover original teletext packet by threshold and differential."""
         if not self.is_teletext:
             return 'rejected'
@@ -223,15 +332,271 @@ class Line(object):
 
         packet = Packet(np.packbits(result.reshape(-1,8)[:,::-1]), number=self._number, original=self._original_bytes)
 
-        m = packet.mrag
-        if m.magazine in mags and m.row in rows:
+        if keep(packet, mags, rows, pages):
             return packet
         else:
             return 'filtered'
 
-def process_lines(chunks, mode, config, force_cpu=False, mags=range(9), rows=range(32)):
+    def hybrid(self, mags=range(9), rows=range(32), threshold=0, pages=None):
+        """Slice the line, and deconvolve it only if the sliced packet has errors."""
+        packet = self.slice()
+        if packet == 'rejected':
+            return packet
+        elif needs_deconvolve(packet, threshold):
+            if unwanted(packet, mags, rows):
+                return 'filtered'
+            return self.deconvolve(mags, rows, pages)
+
+        if keep(packet, mags, rows, pages):
+            return packet
+        else:
+            return 'filtered'
+
+# LineBatch: Handles a block of lines of raw VBI samples at once.
+
+class LineBatch(object):
+    """Container for a block of lines of raw samples, stored as a 2D array.
+
+    This does the same work as Line, but each step is done for every line
+    in the block with one numpy call, instead of one call per line.
+    """
+
+    def __init__(self, data, numbers):
+        if not Line.configured:
+            Line.configure(Config())
+
+        self._numbers = [int(n) for n in numbers]
+        raw = np.frombuffer(data, dtype=Line.config.dtype).reshape(len(self._numbers), -1)
+        self._original = raw.astype(np.float32)
+        self._original /= 256 ** (np.dtype(Line.config.dtype).itemsize-1)
+        self._original_bytes = raw.view(np.uint8)
+
+        self._is_teletext = None
+        self._start = None
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Build a batch from a list of (number, bytes) chunks."""
+        return cls(b''.join(chunk for _, chunk in chunks), (number for number, _ in chunks))
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def chop(self, start, stop):
+        """Chop and average the samples associated with each bit, for every teletext line."""
+        r = self.start
+        idx = Line.config.bit_bounds[None, :, start:stop] - r[:, None, None]
+        bounds = self._gather(idx)
+        return (bounds[:, 1] - bounds[:, 0]) / Line.config.bit_lengths[start:stop]
+
+    def _gather(self, idx):
+        """Gather idx[n, ...] from the cumulative sum of the nth teletext line,
+        with samples beyond either end of the line counting as zero."""
+        flat = np.clip(idx.reshape(idx.shape[0], -1), 0, self._cumsum.shape[1] - 1)
+        return np.take_along_axis(self._cumsum, flat, axis=1).reshape(idx.shape)
+
+    @property
+    def is_teletext(self):
+        """Boolean array marking which lines contain a teletext signal."""
+        if self._is_teletext is None:
+            config = Line.config
+            if config.start_slice.start == 0:
+                noisefloor = np.max(gauss(self._original[:, config.line_trim:-4], config.gauss, axis=1), axis=1)
+            else:
+                noisefloor = np.max(gauss(self._original[:, :config.start_slice.start], config.gauss, axis=1), axis=1)
+            self._gstart = gauss(self._original[:, config.start_slice], config.gauss, axis=1)
+            smax = np.max(self._gstart, axis=1)
+            self._is_teletext = (smax >= 64) & (noisefloor <= 80) & (smax >= (noisefloor + 16))
+            # Only lines which pass the level checks need the FFT.
+            candidates = np.flatnonzero(self._is_teletext)
+            if len(candidates):
+                fft = np.abs(np.fft.fft(np.diff(self._original[candidates], n=1, axis=1), axis=1)[:, :256])
+                fft = normalise_rows(gauss(fft, 4, axis=1))
+                fftchop = np.add.reduceat(fft, config.fftbins, axis=1)
+                self._is_teletext[candidates] = np.sum(fftchop[:, 1:-1:2], axis=1) > 1000
+            # Cumulative sum of each teletext line, with a leading zero, for chopping.
+            # Samples are whole multiples of 1/256 so these sums are exact.
+            teletext_original = self._original[self._is_teletext]
+            self._cumsum = np.zeros((teletext_original.shape[0], teletext_original.shape[1] + 1), dtype=np.float64)
+            np.cumsum(teletext_original, axis=1, dtype=np.float64, out=self._cumsum[:, 1:])
+        return self._is_teletext
+
+    @property
+    def teletext(self):
+        """Indices of the lines which contain a teletext signal."""
+        return np.flatnonzero(self.is_teletext)
+
+    @property
+    def start(self):
+        """Start offsets of each teletext line, in the same order as chop()."""
+        if self._start is None:
+            teletext = self.teletext
+            gstart = self._gstart[teletext]
+            self._start = -np.argmax(np.gradient(np.maximum.accumulate(gstart, axis=1), axis=1), axis=1)
+            # Chop CRI/FC bits 15:20 at every roll of every line with one gather.
+            config = Line.config
+            bounds = self._gather(config.roll_bits[None, :, :] - self._start[:, None, None])
+            chops = np.diff(bounds, axis=2) / config.bit_lengths[15:20]
+            confidence = np.sum(chops * config.crifc[15:20], axis=2)
+            # Ties go to the highest roll, as in Line.start.
+            self._start += config.rolls[::-1][np.argmax(confidence[:, ::-1], axis=1)]
+        return self._start
+
+    def _results(self, packets, mags, rows):
+        """Merge packets for the teletext lines with 'rejected' for the rest."""
+        results = ['rejected'] * len(self)
+        for i, packet in zip(self.teletext, packets):
+            if packet is None:
+                results[i] = 'filtered'
+            else:
+                m = packet.mrag
+                results[i] = packet if m.magazine in mags and m.row in rows else 'filtered'
+        return results
+
+    def _packet(self, i, bytes_array):
+        return Packet(bytes_array, number=self._numbers[i], original=self._original_bytes[i].tobytes())
+
+    def _deconvolve(self, which, mags, rows, pages=None, packets=None):
+        """Deconvolve the teletext lines at positions which.
+
+        Returns a list with one entry per teletext line, taken from packets
+        if given, with the deconvolved packets filled in and None for lines
+        that were filtered. If pages is a PageTracker, rows of pages that
+        are not wanted are not matched.
+        """
+        packets = [None] * len(self.teletext) if packets is None else list(packets)
+        positions = np.arange(len(packets))[which]
+        bits_arrays = normalise_rows(self.chop(0, 368)[positions])
+        bytes_arrays = np.zeros((bits_arrays.shape[0], 42), dtype=np.uint8)
+
+        # First match just the mrag and dc for every line.
+        if len(positions):
+            bytes_arrays[:, :3] = Line.h.match_many(list(bits_arrays[:, 16:56]))
+        lines = {}
+        for p, bytes_array, bits_array in zip(positions, bytes_arrays, bits_arrays):
+            packets[p] = None
+            lines[p] = (bytes_array, bits_array, Mrag(bytes_array[:2]), DesignationCode((1, ), bytes_array[2:3]))
+
+        if pages is None:
+            todo = [p for p, (_, _, m, _) in lines.items() if wanted(m, mags, rows)]
+        else:
+            # Headers are matched first so that the pages they start can be followed.
+            self._match([p for p, (_, _, m, _) in lines.items() if m.row == 0 and wanted(m, mags, rows)], lines, packets)
+            todo = self._follow(pages, packets, {p: m for p, (_, _, m, _) in lines.items() if m.row != 0}, mags, rows)
+
+        # Then match everything else for every line at once.
+        self._match(todo, lines, packets)
+        return packets
+
+    def _match(self, todo, lines, packets):
+        """Match the rest of the lines at positions todo, and store their packets."""
+        Line.match_plans([(bytes_array, bits_array, match_plan(m, d)) for bytes_array, bits_array, m, d in (lines[p] for p in todo)])
+        teletext = self.teletext
+        for p in todo:
+            packets[p] = self._packet(teletext[p], lines[p][0])
+
+    def _follow(self, pages, packets, pending, mags, rows):
+        """Follow the lines in order with a PageTracker.
+
+        Packets from pages that are not wanted are replaced with None.
+        pending maps the positions of lines which have not been matched yet
+        to their mrag. Returns the positions of those which should be.
+        """
+        todo = []
+        position = 0
+        for number, is_teletext in zip(self._numbers, self.is_teletext):
+            pages.follow(number)
+            if is_teletext:
+                if position in pending:
+                    if wanted(pending[position], mags, rows, pages):
+                        todo.append(position)
+                elif packets[position] is not None and not pages.update(packets[position]):
+                    packets[position] = None
+                position += 1
+        return todo
+
+    def _rejected(self, pages):
+        """Results for a batch with no teletext lines."""
+        if pages is not None:
+            self._follow(pages, [], {}, range(9), range(32))
+        return ['rejected'] * len(self)
+
+    def _slice(self):
+        """Slice every teletext line. Returns a list of packets."""
+        bits_arrays = normalise_rows(self.chop(23, 360))
+        diff = np.diff(bits_arrays, n=1, axis=1)
+        ones = (diff > 48)
+        zeros = (diff > -48)
+        result = ((bits_arrays[:, 1:] > 127) | ones) & zeros
+        bytes_arrays = np.packbits(result.reshape(result.shape[0], -1, 8)[:, :, ::-1], axis=2)[:, :, 0]
+        return [self._packet(i, b) for i, b in zip(self.teletext, bytes_arrays)]
+
+    def deconvolve(self, mags=range(9), rows=range(32), pages=None):
+        """Recover original teletext packets by pattern recognition. Returns a list."""
+        if not np.any(self.is_teletext):
+            return self._rejected(pages)
+        return self._results(self._deconvolve(slice(None), mags, rows, pages), mags, rows)
+
+    def slice(self, mags=range(9), rows=range(32), pages=None):
+        """Recover original teletext packets by threshold and differential. Returns a list."""
+        if not np.any(self.is_teletext):
+            return self._rejected(pages)
+        packets = self._slice()
+        if pages is not None:
+            self._follow(pages, packets, {}, mags, rows)
+        return self._results(packets, mags, rows)
+
+    def hybrid(self, mags=range(9), rows=range(32), threshold=0, pages=None):
+        """Slice every line, and deconvolve only the ones with errors. Returns a list."""
+        if not np.any(self.is_teletext):
+            return self._rejected(pages)
+        packets = self._slice()
+        redo = []
+        for n, packet in enumerate(packets):
+            if needs_deconvolve(packet, threshold):
+                if unwanted(packet, mags, rows):
+                    packets[n] = None
+                else:
+                    redo.append(n)
+        if redo or pages is not None:
+            packets = self._deconvolve(redo, mags, rows, pages, packets)
+        return self._results(packets, mags, rows)
+
+
+def decode(obj, mode, mags, rows, threshold, pages=None):
+    """Call the decoding method for mode on a Line or LineBatch."""
+    if mode == 'hybrid':
+        return obj.hybrid(mags, rows, threshold, pages)
+    return getattr(obj, mode)(mags, rows, pages)
+
+
+def process_lines(chunks, mode, config, force_cpu=False, mags=range(9), rows=range(32), search='brute', eps=0, shared=None, threshold=0, scheduled=False, pages=None):
+    """Decode (number, bytes) chunks. If scheduled is True each item is
+    (mode, (number, bytes)) instead, as made by realtime.Scheduler. If pages
+    is a PageTracker, rows of pages it does not want are skipped."""
+    if mode == 'slice':
+        force_cpu = True
+    Line.configure(config, force_cpu, search, eps, shared)
+    for item in chunks:
+        m, (number, chunk) = item if scheduled else (mode, item)
+        if pages is not None:
+            pages.follow(number)
+        yield decode(Line(chunk, number), m, mags, rows, threshold, pages)
+    if eps:
+        Line.report_disagreement()
+
+
+def process_blocks(blocks, mode, config, force_cpu=False, mags=range(9), rows=range(32), search='brute', eps=0, shared=None, threshold=0, scheduled=False, pages=None, source=None):
+    """Like process_lines, but each item is a (numbers, lines) block as made
+    by FileChunker with block set, and each result is the list of results
+    for that block. If lines is None they are read from source."""
     if mode == 'slice':
         force_cpu = True
-    Line.configure(config, force_cpu)
-    for number, chunk in chunks:
-        yield getattr(Line(chunk, number), mode)(mags, rows)
+    Line.configure(config, force_cpu, search, eps, shared)
+    for item in blocks:
+        m, (numbers, lines) = item if scheduled else (mode, item)
+        if lines is None:
+            lines = source.read(numbers)
+        yield decode(LineBatch(lines, numbers), m, mags, rows, threshold, pages)
+    if eps:
+        Line.report_disagreement()
@@ -0,0 +1,61 @@
+class PageTracker(object):
+
+    """
+    Follows which page each magazine is sending, so that rows of pages
+    which are not wanted can be skipped before they are fully decoded.
+
+    This uses the same rules as pipeline.paginate: a header starts a new
+    page in its magazine, and every other row after it belongs to that
+    page until the next header in the same magazine.
+
+    Decoding workers only see part of the input each, so until they have
+    seen a header in a magazine its current page is unknown and its rows
+    are assumed to be wanted. The same goes for headers with errors in
+    the page number, and for every magazine after a gap in the line
+    numbers, because the missing lines could have contained headers.
+    Headers are always kept, so that filter() can put the results back
+    together and remove the extra rows.
+    """
+
+    def __init__(self, pages=range(0x900), subpages=range(0x3f80)):
+        self.pages = pages
+        self.subpages = subpages
+        self._next = None
+        self.reset()
+
+    def reset(self):
+        """Forget the current page of every magazine."""
+        self._wanted = [None] * 8
+
+    def wanted(self, packet):
+        """Whether a header starts a wanted page."""
+        page = packet.header.page | (packet.mrag.magazine * 0x100)
+        return (page in self.pages or (page & 0x7ff) in self.pages) and packet.header.subpage in self.subpages
+
+    def follow(self, number):
+        """Forget the current pages unless number is the line after the previous one."""
+        if number is None or number != self._next:
+            self.reset()
+        self._next = None if number is None else number + 1
+
+    def row(self, mrag):
+        """Whether a row might belong to a wanted page."""
+        return mrag.row == 0 or self._wanted[mrag.magazine & 0x7] is not False
+
+    def update(self, packet):
+        """Follow a decoded packet and return whether to keep it."""
+        m = packet.mrag
+        if m.row == 0:
+            self._wanted[m.magazine & 0x7] = None if packet.errors[:8].any() else self.wanted(packet)
+        return self.row(m)
+
+    def filter(self, packets, rows=range(32)):
+        """Yield the packets in wanted pages, as pipeline.paginate would
+        find them, but in their original order."""
+        wanted = [False] * 8
+        for packet in packets:
+            m = packet.mrag
+            if m.row == 0:
+                wanted[m.magazine & 0x7] = self.wanted(packet)
+            if wanted[m.magazine & 0x7] and m.row in rows:
+                yield packet
@@ -8,37 +8,258 @@
 # * warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
 # * GNU General Public License for more details.
 
+import hashlib
 import itertools
+import os
 import struct
+import tempfile
 from collections import defaultdict
+from multiprocessing import shared_memory
 
 import numpy as np
 
 from tqdm import tqdm
 
 
+def cache_dir():
+    """Where to keep pre-converted pattern tables."""
+    if 'TELETEXT_CACHE' in os.environ:
+        return os.environ['TELETEXT_CACHE']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'teletext')
+
+
+def _write_atomic(path, write):
+    """Write a file under a temporary name and rename it into place.
+
+    Other processes never see a partly written file, and the temporary
+    file is removed if anything goes wrong.
+    """
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False)
+    try:
+        with f:
+            write(f)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def convert_tables(data):
+    """Parse a pattern file and build the arrays used for matching."""
+    inlen, outlen, n, start, end = struct.unpack('>IIIBB', data[:14])
+    patterns = np.frombuffer(data, dtype=np.uint8, count=inlen*n, offset=14)
+    patterns = patterns.reshape((n, inlen)).astype(np.float32)
+    bytes = np.frombuffer(data, dtype=np.uint8, count=outlen*n, offset=14+(inlen*n))
+    bytes = bytes.reshape((n, outlen))
+    # Squared norm of each pattern, for the expanded form of the
+    # squared distance: |p - w|^2 = |p|^2 - 2p.w + |w|^2
+    pslice64 = patterns[:, start:end].astype(np.float64)
+    pnorms = np.sum(pslice64 * pslice64, axis=1)
+    return {'patterns': patterns, 'bytes': bytes, 'pslice64': pslice64, 'pnorms': pnorms}
+
+
+def load_tables(filename, cache=True):
+    """Load the arrays for a pattern file.
+
+    The converted arrays are saved as .npy files keyed by a hash of the
+    pattern file, and memory-mapped read-only on later loads. This means
+    every process using the same tables shares them through the page cache.
+    A stamp file records the size and mtime of the pattern file along with
+    its hash, so the file is only read and hashed again when it changes.
+
+    cache may be False to skip the cache, or a directory to use instead of
+    cache_dir().
+    """
+    if not cache:
+        with open(filename, 'rb') as f:
+            return convert_tables(f.read())
+
+    d = cache_dir() if cache is True else cache
+    name = os.path.splitext(os.path.basename(filename))[0]
+    names = ('patterns', 'bytes', 'pslice64', 'pnorms')
+    where = hashlib.sha1(os.path.abspath(filename).encode('utf8')).hexdigest()[:16]
+    stamp_path = os.path.join(d, f'{name}.{where}.stamp')
+    st = os.stat(filename)
+    stamp = f'{st.st_size} {st.st_mtime_ns}'
+
+    key = None
+    try:
+        with open(stamp_path) as f:
+            size, mtime, key = f.read().split()
+        if f'{size} {mtime}' != stamp:
+            key = None
+    except (OSError, ValueError):
+        pass
+
+    if key is not None:
+        try:
+            return {a: np.load(os.path.join(d, f'{name}.{key}.{a}.npy'), mmap_mode='r') for a in names}
+        except (OSError, ValueError):
+            pass
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    key = hashlib.sha1(data).hexdigest()[:16]
+    paths = {a: os.path.join(d, f'{name}.{key}.{a}.npy') for a in names}
+    try:
+        arrays = {a: np.load(p, mmap_mode='r') for a, p in paths.items()}
+    except (OSError, ValueError):
+        arrays = convert_tables(data)
+        try:
+            os.makedirs(d, exist_ok=True)
+            for a in names:
+                _write_atomic(paths[a], lambda f: np.save(f, arrays[a]))
+        except OSError:
+            # The tables still work from memory.
+            return arrays
+
+    try:
+        _write_atomic(stamp_path, lambda f: f.write(f'{stamp} {key}'.encode('ascii')))
+    except OSError:
+        pass
+    return arrays
+
+
+class SharedTables(object):
+    """Pattern table arrays for several pattern files, in one named shared memory segment.
+
+    The parent process creates this with the pattern files it wants to share
+    and passes SharedTables.descriptor to the workers, which call attach() to
+    get numpy arrays backed by the shared memory instead of private copies.
+    The parent must keep it open until the workers have finished.
+    """
+
+    def __init__(self, filenames, cache=True):
+        tables = {os.path.abspath(f): load_tables(f, cache) for f in filenames}
+        layout = {}
+        size = 0
+        for filename, arrays in tables.items():
+            layout[filename] = {}
+            for name, a in arrays.items():
+                size = -(-size // 64) * 64 # align every array to 64 bytes
+                layout[filename][name] = (size, a.shape, a.dtype.str)
+                size += a.nbytes
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        for filename, arrays in tables.items():
+            for name, a in arrays.items():
+                offset, shape, dtype = layout[filename][name]
+                np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)[:] = a
+        self.descriptor = (self._shm.name, layout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+    # Workers must keep their segments open for as long as they use the arrays.
+    _attached = {}
+
+    @classmethod
+    def attach(cls, descriptor):
+        """Return {filename: arrays} for a descriptor made by the parent process."""
+        name, layout = descriptor
+        if name not in cls._attached:
+            # Only the parent may unlink the segment. Worker processes share
+            # the parent's resource tracker, so registering it again there
+            # is harmless, but don't track it at all where that is possible.
+            try:
+                cls._attached[name] = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                cls._attached[name] = shared_memory.SharedMemory(name=name)
+        buf = cls._attached[name].buf
+        tables = {}
+        for filename, arrays in layout.items():
+            tables[filename] = {}
+            for a, (offset, shape, dtype) in arrays.items():
+                arr = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+                arr.flags.writeable = False
+                tables[filename][a] = arr
+        return tables
+
+
 class Pattern(object):
 
-    def __init__(self, filename):
+    # Ways to search for the closest pattern.
+    searches = ('brute', 'kdtree')
+
+    # In approximate mode, check every Nth match against brute force.
+    check_interval = 100
+
+    def __init__(self, filename, search='brute', eps=0, cache=True, tables=None):
         with open(filename, 'rb') as f:
             self.inlen,self.outlen,self.n,self.start,self.end = struct.unpack('>IIIBB', f.read(14))
-            self.patterns = np.fromfile(f, dtype=np.uint8, count=self.inlen*self.n)
-            self.patterns = self.patterns.reshape((self.n, self.inlen))
-            self.patterns = self.patterns.astype(np.float32)
-            self.bytes = np.fromfile(f, dtype=np.uint8, count=self.outlen*self.n)
-            self.bytes = self.bytes.reshape((self.n, self.outlen))
+        if tables is not None and os.path.abspath(filename) in tables:
+            arrays = tables[os.path.abspath(filename)]
+        else:
+            arrays = load_tables(filename, cache)
+        self.patterns = arrays['patterns']
+        self.bytes = arrays['bytes']
         self.pslice = self.patterns[:, self.start:self.end]
+        self.pslice64 = arrays['pslice64']
+        self.pnorms = arrays['pnorms']
+
+        if search not in self.searches:
+            raise ValueError(f'Unknown pattern search method: {search}')
+        self.search = search
+        self.eps = eps
+        self.checked = 0
+        self.disagreed = 0
+        if search == 'kdtree':
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.pslice64)
+
+    def windows(self, inp):
+        """Return a 2D view of every byte window in inp, one row per byte."""
+        l = (len(inp)//8)-2
+        w = np.lib.stride_tricks.sliding_window_view(inp, self.end - self.start)
+        return w[self.start:self.start + (l*8):8]
+
+    def brute_force(self, windows, block=65536*64):
+        """Return the index of the closest pattern to each row of windows, by checking all of them."""
+        idx = np.empty((windows.shape[0],), dtype=np.intp)
+        # Limit the size of the distance matrix by matching in blocks.
+        rows = max(1, block // self.n)
+        for i in range(0, windows.shape[0], rows):
+            # |w|^2 is the same for every pattern so it doesn't affect argmin.
+            d = self.pnorms - 2 * (windows[i:i+rows] @ self.pslice64.T)
+            idx[i:i+rows] = np.argmin(d, axis=1)
+        return idx
+
+    def match_windows(self, windows, block=65536*64):
+        """Find the closest pattern to each row of windows and return its byte."""
+        windows = np.asarray(windows, dtype=np.float64)
+        if self.search == 'kdtree':
+            # With eps > 0 the tree may return a pattern up to (1+eps) times
+            # further away than the closest one.
+            _, idx = self.tree.query(windows, eps=self.eps)
+            if self.eps > 0:
+                sample = slice(None, None, self.check_interval)
+                expected = self.bytes[self.brute_force(windows[sample], block), 0]
+                self.checked += len(expected)
+                self.disagreed += np.count_nonzero(self.bytes[idx[sample], 0] != expected)
+        else:
+            idx = self.brute_force(windows, block)
+        return self.bytes[idx, 0]
+
+    @property
+    def disagreement(self):
+        """Fraction of checked approximate matches which differ from brute force."""
+        return self.disagreed / max(1, self.checked)
+
+    def match_many(self, inps):
+        """Match a list of inputs in a single call. Returns a list of results."""
+        windows = [self.windows(inp) for inp in inps]
+        result = self.match_windows(np.concatenate(windows))
+        return np.split(result, np.cumsum([len(w) for w in windows])[:-1])
 
     def match(self, inp):
-        l = (len(inp)//8)-2
-        idx = np.empty((l,), dtype=np.uint32)
-        for i in range(l):
-            start = (i*8) + self.start
-            end = (i*8) + self.end
-            diffs = self.pslice - inp[start:end]
-            diffs = diffs * diffs
-            idx[i] = np.argmin(np.sum(diffs, axis=1))
-        return self.bytes[idx][:,0]
+        return self.match_windows(self.windows(inp))
 
     def similarities(self):
 
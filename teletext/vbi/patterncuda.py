@@ -88,3 +88,5 @@ class PatternCUDA(Pattern):
         result = self.result_argmin.get()
         return self.bytes[result[:l],0]
 
+    def match_many(self, inps):
+        return [self.match(inp) for inp in inps]
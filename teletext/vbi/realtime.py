@@ -0,0 +1,76 @@
+import sys
+import time
+
+
+class Scheduler(object):
+
+    """
+    Decides how much work to spend on each line of a live capture.
+
+    The capture produces lines at a fixed rate. If decoding falls behind,
+    lines pile up in the capture buffer or pipe. Scheduler compares the
+    number of lines read so far with the number the capture should have
+    produced by now, and picks a cheaper mode for each new work item as
+    the lag grows:
+
+        lag < max_lag:          the requested mode
+        otherwise:              slice, keeping only the selected rows
+
+    Lines are never dropped, so rows which were asked for are never lost.
+    Slicing is several times faster than a capture produces lines, even
+    on one core, so the backlog shrinks again once lines are sliced.
+    Skipping the unselected rows doesn't make slicing any cheaper, as the
+    row is only known once the line has been sliced, so there is no
+    separate level for it.
+
+    Items are yielded as (mode, item) for process_lines or process_blocks
+    with scheduled=True.
+    """
+
+    label = 'RT'
+
+    def __init__(self, mode, rate, max_lag=1.0, lines_per_item=1):
+        self.modes = (mode, 'slice')
+        self.rate = rate
+        self.max_lag = max_lag
+        self.lines_per_item = lines_per_item
+        self.counts = {mode: 0, 'slice': 0}
+        self._start = None
+        self._lines = 0
+
+    @property
+    def lag(self):
+        """Seconds of capture that are waiting to be read."""
+        if self._start is None:
+            return 0
+        return (time.monotonic() - self._start) - (self._lines / self.rate)
+
+    def choose(self):
+        """The mode to use for the next item."""
+        levels = int(self.lag // self.max_lag) if self.max_lag > 0 else 0
+        return self.modes[min(max(0, levels), len(self.modes) - 1)]
+
+    def schedule(self, items):
+        for item in items:
+            if self._start is None:
+                # The clock starts when the first line arrives.
+                self._start = time.monotonic()
+            mode = self.choose()
+            self._lines += self.lines_per_item
+            self.counts[mode] += self.lines_per_item
+            yield mode, item
+
+    @property
+    def downgraded(self):
+        """Number of lines that were not decoded with the requested mode."""
+        return sum(self.counts.values()) - self.counts[self.modes[0]]
+
+    def __str__(self):
+        total = max(1, sum(self.counts.values()))
+        return f', {self.label}:{100*self.downgraded/total:.0f}%'
+
+    def report(self, results):
+        """Pass results through, then print how many lines were downgraded."""
+        yield from results
+        counts = ', '.join(f'{k}: {v}' for k, v in self.counts.items())
+        sys.stderr.write(f'Realtime: {self.downgraded} lines downgraded. {counts}.\n')